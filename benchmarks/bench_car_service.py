@@ -0,0 +1,184 @@
+"""Бенчмарк операций CarService на синтетических данных.
+
+Запуск из корня проекта (src должен быть в PYTHONPATH, как и для тестов):
+
+    PYTHONPATH=src python benchmarks/bench_car_service.py --size 10k --output baseline.json
+    PYTHONPATH=src python benchmarks/bench_car_service.py --size 10k --baseline baseline.json
+
+Данные загружаются через bulk_load_*, затем каждая операция выполняется --ops раз.
+Для операции записываются пропускная способность и задержки p50/p99, для прогона —
+время загрузки, пиковый RSS и размер каталога на диске. С --baseline результат
+сравнивается с сохранённым, и при регрессиях скрипт завершается с кодом 1.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Iterable
+
+from bibip_car_service import CarService
+from datagen import DataGenerator
+from models import Car, CarStatus, Sale
+
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+DEFAULT_OPS = 1000
+SCAN_OPS = 5  # get_cars возвращает все машины со статусом, поэтому вызовов меньше
+REGRESSION_THRESHOLD = 0.2  # допустимое ухудшение относительно базового прогона
+
+
+def _percentile(timings: list[int], q: float) -> float:
+    # timings отсортированы, в наносекундах; результат в миллисекундах
+    if not timings:
+        return 0.0
+    return timings[min(len(timings) - 1, int(q * len(timings)))] / 1e6
+
+
+def measure(calls: Iterable[Callable[[], object]]) -> dict:
+    timings = []
+    started = time.perf_counter_ns()
+    for call in calls:
+        t = time.perf_counter_ns()
+        call()
+        timings.append(time.perf_counter_ns() - t)
+    total = (time.perf_counter_ns() - started) / 1e9
+    timings.sort()
+    return {
+        "ops": len(timings),
+        "total_s": round(total, 4),
+        "throughput_per_s": round(len(timings) / total, 1) if total else 0.0,
+        "p50_ms": round(_percentile(timings, 0.50), 4),
+        "p99_ms": round(_percentile(timings, 0.99), 4),
+    }
+
+
+def _disk_size(root: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(root) if entry.is_file())
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run(rows: int, seed: int, ops: int, root: str) -> dict:
+    gen = DataGenerator(rows, seed)
+    rnd = random.Random(seed)
+    result: dict = {
+        "rows": rows,
+        "seed": seed,
+        "ops": ops,
+        "python": platform.python_version(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "load": {},
+        "operations": {},
+    }
+
+    service = CarService(root)
+    for name, load, source, count in [
+        ("models", service.bulk_load_models, gen.model_rows(), gen.models),
+        ("cars", service.bulk_load_cars, gen.car_rows(), rows),
+        ("sales", service.bulk_load_sales, gen.sale_rows(), int(rows * gen.sold_ratio)),
+    ]:
+        started = time.perf_counter()
+        load(source)
+        elapsed = time.perf_counter() - started
+        result["load"][name] = {"rows": count, "total_s": round(elapsed, 3),
+                                "rows_per_s": round(count / elapsed, 1) if elapsed else 0.0}
+
+    # Машины для операций выбираются заранее, чтобы подготовка не попала в замеры
+    sample = [gen.vin(i) for i in rnd.sample(range(rows), min(rows, 4 * ops))]
+    available = [vin for vin in sample if service.get_car_info(vin).status != CarStatus.sold]
+    to_sell, to_rename = available[:ops], available[ops: 2 * ops]
+    to_read = [gen.vin(i) for i in rnd.sample(range(rows), min(rows, ops))]
+    service.flush()
+    # Прочитанные при выборе машины не должны попадать в кэш замеров
+    service.info_cache.clear()
+
+    new_cars = [Car(**row) for row in gen.car_rows(rows, rows + ops)]
+    sales = [Sale(sales_number=f"bench#{vin}", car_vin=vin, sales_date=datetime(2024, 1, 1), cost=Decimal("1000"))
+             for vin in to_sell]
+    new_vins = [gen.vin(rows + ops + i) for i in range(len(to_rename))]
+    statuses = [CarStatus.available, CarStatus.reserve, CarStatus.sold]
+
+    operations = result["operations"]
+    operations["add_car"] = measure(lambda car=car: service.add_car(car) for car in new_cars)
+    operations["get_car_info"] = measure(lambda vin=vin: service.get_car_info(vin) for vin in to_read)
+    operations["get_car_info_cached"] = measure(lambda vin=vin: service.get_car_info(vin) for vin in to_read)
+    operations["sell_car"] = measure(lambda sale=sale: service.sell_car(sale) for sale in sales)
+    operations["update_vin"] = measure(
+        lambda old=old, new=new: service.update_vin(old, new) for old, new in zip(to_rename, new_vins))
+    operations["revert_sale"] = measure(lambda sale=sale: service.revert_sale(sale.sales_number) for sale in sales)
+    operations["get_cars"] = measure(
+        lambda status=statuses[i % len(statuses)]: service.get_cars(status) for i in range(SCAN_OPS))
+    operations["top_models_by_sales"] = measure(lambda: service.top_models_by_sales() for _ in range(ops))
+
+    service.close()
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["disk_mb"] = round(_disk_size(root) / (1024 * 1024), 2)
+    return result
+
+
+def compare(result: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list[str]:
+    """Список регрессий: пропускная способность ниже или p99, память, диск выше порога."""
+    regressions = []
+    for name, current in result["operations"].items():
+        base = baseline.get("operations", {}).get(name)
+        if base is None:
+            continue
+        if current["throughput_per_s"] < base["throughput_per_s"] * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput {current['throughput_per_s']}/s < baseline {base['throughput_per_s']}/s")
+        if current["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p99 {current['p99_ms']} ms > baseline {base['p99_ms']} ms")
+    for key in ("peak_rss_mb", "disk_mb"):
+        if key in baseline and result[key] > baseline[key] * (1 + threshold):
+            regressions.append(f"{key}: {result[key]} > baseline {baseline[key]}")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", default="10k", help=f"{', '.join(SIZES)} или число машин")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--ops", type=int, default=DEFAULT_OPS, help="вызовов каждой операции")
+    parser.add_argument("--root", help="каталог данных; по умолчанию временный, удаляется после прогона")
+    parser.add_argument("--output", help="куда записать результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    rows = SIZES.get(args.size.lower()) or int(args.size)
+    root = args.root or tempfile.mkdtemp(prefix="bibip-bench-")
+    try:
+        result = run(rows, args.seed, args.ops, root)
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+    result["size"] = args.size
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Детерминированный генератор данных для бенчмарков.
+
+Строки выдаются словарями в формате выгрузок, поэтому их можно сразу отдавать в
+bulk_load_models/cars/sales, не держа в памяти все объекты.
+"""
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Iterator
+
+# Символы VIN: латиница без I, O, Q и цифры
+VIN_CHARS = "ABCDEFGHJKLMNPRSTUVWXYZ0123456789"
+_TRANSLITERATION = dict(zip("ABCDEFGHJKLMNPRSTUVWXYZ", [1, 2, 3, 4, 5, 6, 7, 8, 1, 2, 3, 4, 5, 7, 9, 2, 3, 4, 5, 6,
+                                                        7, 8, 9]))
+_WEIGHTS = [8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2]
+
+# Производитель (WMI) -> марка
+MANUFACTURERS = {
+    "KNA": "Kia", "5XY": "Kia", "JM1": "Mazda", "5N1": "Nissan", "VF1": "Renault", "WVW": "Volkswagen",
+    "WBA": "BMW", "1HG": "Honda", "JTD": "Toyota", "XTA": "Lada", "TMB": "Skoda", "KMH": "Hyundai",
+}
+MODEL_NAMES = ["Sedan", "Hatch", "Wagon", "Coupe", "Cross", "Van", "Pickup", "Roadster", "Compact", "Tourer"]
+STATUSES = ["available", "available", "available", "reserve", "delivery"]
+
+START_DATE = datetime(2020, 1, 1)
+
+
+def _check_digit(vin: str) -> str:
+    total = sum((int(c) if c.isdigit() else _TRANSLITERATION[c]) * w for c, w in zip(vin, _WEIGHTS))
+    remainder = total % 11
+    return "X" if remainder == 10 else str(remainder)
+
+
+def make_vin(wmi: str, serial: int, noise: int) -> str:
+    """VIN из 17 символов с настоящей контрольной цифрой.
+
+    Завод и шесть цифр серийного номера кодируют serial, поэтому VIN уникальны до
+    33 миллионов машин; описательная часть и год берутся из noise.
+    """
+    vds = ""
+    for _ in range(5):
+        noise, digit = divmod(noise, len(VIN_CHARS))
+        vds += VIN_CHARS[digit]
+    year = VIN_CHARS[noise % len(VIN_CHARS)]
+    plant = VIN_CHARS[serial // 1_000_000 % len(VIN_CHARS)]
+    vin = f"{wmi}{vds}0{year}{plant}{serial % 1_000_000:06d}"
+    return vin[:8] + _check_digit(vin) + vin[9:]
+
+
+def _mix(value: int) -> int:
+    # Перемешивание битов (splitmix64): случайный на вид, но воспроизводимый шум по номеру
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+class DataGenerator:
+    """Модели, машины и продажи для набора из cars машин.
+
+    Один seed даёт один и тот же набор. VIN машины номер i вычисляется по i, поэтому
+    бенчмарк может выбирать машины для операций, не храня список всех VIN.
+    """
+
+    def __init__(self, cars: int, seed: int = 42, models: int | None = None, sold_ratio: float = 0.3) -> None:
+        self.cars = cars
+        self.seed = seed
+        self.models = models or max(10, min(1000, cars // 1000))
+        self.sold_ratio = sold_ratio
+        self._wmis = list(MANUFACTURERS)
+
+    def _rnd(self, stream: str) -> random.Random:
+        return random.Random(f"{self.seed}:{stream}")
+
+    def model_rows(self) -> Iterator[dict]:
+        rnd = self._rnd("models")
+        for model_id in range(1, self.models + 1):
+            brand = MANUFACTURERS[rnd.choice(self._wmis)]
+            yield {"id": model_id, "name": f"{rnd.choice(MODEL_NAMES)} {model_id}", "brand": brand}
+
+    def vin(self, i: int) -> str:
+        # VIN машины номер i без генерации всех предыдущих
+        return make_vin(self._wmis[i % len(self._wmis)], i, _mix(self.seed * 1_000_003 + i))
+
+    def car_rows(self, start: int = 0, stop: int | None = None) -> Iterator[dict]:
+        rnd = self._rnd(f"cars:{start}")
+        for i in range(start, self.cars if stop is None else stop):
+            yield {
+                "vin": self.vin(i),
+                "model": rnd.randint(1, self.models),
+                "price": str(Decimal(rnd.randint(500_000, 8_000_000)) / 100),
+                "date_start": (START_DATE + timedelta(minutes=rnd.randint(0, 3 * 365 * 24 * 60))).isoformat(),
+                "status": rnd.choice(STATUSES),
+            }
+
+    def sold_cars(self) -> list[int]:
+        """Номера машин, которые продаются при загрузке, в порядке продажи."""
+        rnd = self._rnd("sold")
+        return rnd.sample(range(self.cars), int(self.cars * self.sold_ratio))
+
+    def sale_rows(self) -> Iterator[dict]:
+        rnd = self._rnd("sales")
+        for i in self.sold_cars():
+            vin = self.vin(i)
+            date = START_DATE + timedelta(days=3 * 365 + rnd.randint(0, 365))
+            yield {
+                "sales_number": f"{date:%Y%m%d}#{vin}",
+                "car_vin": vin,
+                "sales_date": date.isoformat(),
+                "cost": str(Decimal(rnd.randint(400_000, 7_500_000)) / 100),
+            }
@@ -0,0 +1,185 @@
+import calendar
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterable, Sequence
+
+import numpy as np
+
+from models import CarStatus
+from records import MONEY_SCALE, CarRecord, ModelRecord, SaleRecord
+from storage import scan_file
+
+SECONDS_PER_DAY = 86_400
+STATUSES = list(CarStatus)
+GROUP_KEYS = ("brand", "model", "month")
+
+
+def _epoch(value: datetime) -> int:
+    # Наивное время считаем UTC, как и при записи в файлы
+    if value.tzinfo is None:
+        return calendar.timegm(value.timetuple())
+    return int(value.timestamp())
+
+
+@dataclass
+class ColumnarSnapshot:
+    """Снимок моделей, машин и продаж в виде столбцов NumPy.
+
+    Деньги хранятся как int64 в сотых (доли сотой отбрасываются, см. records.scaled_cents),
+    даты — как int64 секунд от начала эпохи.
+    Продажа ссылается на машину позицией в столбцах машин; нужные отчётам поля машины
+    (модель, цена, дата поступления) уже повторены в столбцах продаж, чтобы отчёты
+    обходились без соединения.
+    """
+
+    model_id: np.ndarray
+    model_name: np.ndarray
+    model_brand: np.ndarray
+    car_vin: np.ndarray
+    car_model: np.ndarray
+    car_price: np.ndarray
+    car_date_start: np.ndarray
+    car_status: np.ndarray
+    sale_number: np.ndarray
+    sale_car: np.ndarray
+    sale_date: np.ndarray
+    sale_cost: np.ndarray
+    sale_model: np.ndarray  # позиция модели в столбцах моделей, -1 если модель неизвестна
+    sale_price: np.ndarray
+    sale_date_start: np.ndarray
+    sale_month: np.ndarray  # месяцы от января 1970
+
+    @classmethod
+    def build(
+        cls, models: Iterable[ModelRecord], cars: Iterable[CarRecord], sales: Iterable[SaleRecord]
+    ) -> "ColumnarSnapshot":
+        models = list(models)
+        cars = list(cars)
+        car_pos = {car.vin: i for i, car in enumerate(cars)}
+        sales = [sale for sale in sales if sale.car_vin in car_pos]
+        model_pos = {model.id: i for i, model in enumerate(models)}
+        car_model = np.array([car.model for car in cars], dtype=np.int64)
+        car_price = np.array([car.price_cents for car in cars], dtype=np.int64)
+        car_date_start = np.array([_epoch(car.date_start) for car in cars], dtype=np.int64)
+        car_model_pos = np.array([model_pos.get(car.model, -1) for car in cars], dtype=np.int64)
+        sale_car = np.array([car_pos[sale.car_vin] for sale in sales], dtype=np.int64)
+        sale_date = np.array([_epoch(sale.sales_date) for sale in sales], dtype=np.int64)
+        return cls(
+            model_id=np.array([model.id for model in models], dtype=np.int64),
+            model_name=np.array([model.name for model in models], dtype=str),
+            model_brand=np.array([model.brand for model in models], dtype=str),
+            car_vin=np.array([car.vin for car in cars], dtype=str),
+            car_model=car_model,
+            car_price=car_price,
+            car_date_start=car_date_start,
+            car_status=np.array([STATUSES.index(car.status) for car in cars], dtype=np.int8),
+            sale_number=np.array([sale.sales_number for sale in sales], dtype=str),
+            sale_car=sale_car,
+            sale_date=sale_date,
+            sale_cost=np.array([sale.cost_cents for sale in sales], dtype=np.int64),
+            sale_model=car_model_pos[sale_car],
+            sale_price=car_price[sale_car],
+            sale_date_start=car_date_start[sale_car],
+            # Месяц берётся из того же времени UTC, что и sale_date, а не из местного времени продажи
+            sale_month=sale_date.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64),
+        )
+
+    @classmethod
+    def concat(cls, parts: Sequence["ColumnarSnapshot"]) -> "ColumnarSnapshot":
+        """Снимок из снимков шардов, построенных по одному списку моделей."""
+        if len(parts) == 1:
+            return parts[0]
+        columns = {}
+        for name in vars(parts[0]):
+            if name.startswith("model_"):
+                columns[name] = getattr(parts[0], name)
+            elif name == "sale_car":
+                # Позиции машин сдвигаются на число машин в предыдущих шардах
+                offsets = np.cumsum([0] + [len(part.car_vin) for part in parts[:-1]])
+                columns[name] = np.concatenate([part.sale_car + offset for part, offset in zip(parts, offsets)])
+            else:
+                columns[name] = np.concatenate([getattr(part, name) for part in parts])
+        return cls(**columns)
+
+    def save(self, path: str) -> None:
+        np.savez(path, **vars(self))
+
+    @classmethod
+    def load(cls, path: str) -> "ColumnarSnapshot":
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+
+def build_shard_snapshot(models: list[ModelRecord], cars_path: str, sales_path: str) -> ColumnarSnapshot:
+    # Выполняется в процессе пула (см. sharding.ShardPool): читает файлы шарда сам
+    return ColumnarSnapshot.build(
+        models,
+        (car for _, car in scan_file(cars_path, CarRecord)),
+        (sale for _, sale in scan_file(sales_path, SaleRecord)),
+    )
+
+
+class SalesAnalytics:
+    """Групповые агрегаты по продажам, посчитанные векторно по снимку."""
+
+    def __init__(self, snapshot: ColumnarSnapshot) -> None:
+        self.snapshot = snapshot
+        # Разности для скидки и срока на складе считаются один раз на снимок
+        self._discount = snapshot.sale_price - snapshot.sale_cost
+        self._seconds_on_lot = snapshot.sale_date - snapshot.sale_date_start
+
+    def _group_codes(self, key: str) -> tuple[np.ndarray, list]:
+        # Код группы для каждой продажи и подписи групп
+        s = self.snapshot
+        if key == "model":
+            labels = [(str(name), str(brand)) for name, brand in zip(s.model_name, s.model_brand)]
+            # Неизвестная модель (-1) попадает в последнюю группу
+            return np.where(s.sale_model >= 0, s.sale_model, len(labels)), labels + [("Unknown", "Unknown")]
+        if key == "brand":
+            brands, codes = np.unique(s.model_brand, return_inverse=True)
+            lookup = np.append(codes, len(brands))  # индекс -1 выбирает код "Unknown"
+            return lookup[s.sale_model], [str(brand) for brand in brands] + ["Unknown"]
+        if key == "month":
+            first = int(s.sale_month.min()) if len(s.sale_month) else 0
+            count = int(s.sale_month.max()) - first + 1 if len(s.sale_month) else 0
+            return s.sale_month - first, [str(np.datetime64(first + i, "M")) for i in range(count)]
+        raise ValueError(f"Unknown group key {key!r}, expected one of {GROUP_KEYS}")
+
+    def summary(self, by: Sequence[str] = ("brand",)) -> list[dict]:
+        """Продажи в штуках, выручка, средняя скидка и средний срок на складе по группам.
+
+        by — любые сочетания "brand", "model" и "month".
+        """
+        code = np.zeros(len(self.snapshot.sale_date), dtype=np.int64)
+        dims = []
+        for i, key in enumerate(by):
+            codes, labels = self._group_codes(key)
+            code = codes if i == 0 else code * max(len(labels), 1) + codes
+            dims.append((key, labels))
+        size = int(np.prod([max(len(labels), 1) for _, labels in dims])) if dims else 1
+
+        units = np.bincount(code, minlength=size)
+        # Суммы в float64 точны, пока не превышают 2**53 сотых
+        revenue = np.bincount(code, weights=self.snapshot.sale_cost, minlength=size)
+        discount = np.bincount(code, weights=self._discount, minlength=size)
+        days = np.bincount(code, weights=self._seconds_on_lot, minlength=size)
+
+        rows = []
+        for group in np.flatnonzero(units):
+            row = {}
+            rest = int(group)
+            for key, labels in reversed(dims):
+                rest, i = divmod(rest, max(len(labels), 1))
+                if key == "model":
+                    row["model"], row["brand"] = labels[i]
+                else:
+                    row[key] = labels[i]
+            count = int(units[group])
+            row["units"] = count
+            row["revenue"] = Decimal(int(round(revenue[group]))) / MONEY_SCALE
+            row["average_discount"] = (Decimal(int(round(discount[group]))) / MONEY_SCALE / count).quantize(
+                Decimal("0.01"))
+            row["average_days_on_lot"] = float(days[group] / count / SECONDS_PER_DAY)
+            rows.append(row)
+        return rows
@@ -0,0 +1,115 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+from bibip_car_service import CarService
+from models import Car, CarFullInfo, Model, ModelSaleStats, Sale
+
+WRITE_BATCH_SIZE = 1000  # сколько изменений самое большее фиксируется одним fsync
+READ_WORKERS = 4
+
+
+class AsyncCarService:
+    """Асинхронная обёртка над CarService.
+
+    Чтения выполняются в пуле потоков и идут параллельно. Изменения ставятся в очередь,
+    одна задача-писатель забирает из неё всё накопившееся и выполняет пачкой внутри
+    group_commit(): пачка фиксируется в журнале одним fsync. Пока пачка пишется, в
+    очереди собирается следующая, поэтому под нагрузкой пачки растут сами.
+
+    Ошибка одной операции (например, ValueError при повторной продаже) достаётся только
+    её вызывающему, остальные операции пачки выполняются. Сервис закрывает владелец,
+    aclose() лишь дожидается записей и останавливает потоки.
+    """
+
+    def __init__(self, service: CarService, max_batch: int = WRITE_BATCH_SIZE, read_workers: int = READ_WORKERS):
+        self.service = service
+        self.max_batch = max_batch
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="car-service-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="car-service-write")
+        self._queue: asyncio.Queue | None = None
+        self._write_task: asyncio.Task | None = None
+
+    async def _read(self, method: Callable, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._readers, method, *args)
+
+    async def _write(self, method: Callable, *args: Any) -> Any:
+        if self._write_task is None:
+            self._queue = asyncio.Queue()
+            self._write_task = asyncio.create_task(self._write_loop())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((method, args, future))
+        return await future
+
+    async def _write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            # None в очереди — сигнал остановки от aclose()
+            stopping = None in batch
+            batch = [op for op in batch if op is not None]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(self._writer, self._run_batch, batch)
+            except Exception as exc:
+                # Сбой общей фиксации: неизвестно, какие изменения на диске
+                results = [(False, exc)] * len(batch)
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _run_batch(self, batch: list) -> list[tuple[bool, Any]]:
+        results = []
+        with self.service.group_commit():
+            for method, args, _ in batch:
+                try:
+                    results.append((True, method(*args)))
+                except Exception as exc:
+                    results.append((False, exc))
+        return results
+
+    async def add_model(self, model: Model) -> Model:
+        return await self._write(self.service.add_model, model)
+
+    async def add_car(self, car: Car) -> Car:
+        return await self._write(self.service.add_car, car)
+
+    async def sell_car(self, sale: Sale) -> Car:
+        return await self._write(self.service.sell_car, sale)
+
+    async def update_vin(self, old_vin: str, new_vin: str) -> None:
+        await self._write(self.service.update_vin, old_vin, new_vin)
+
+    async def revert_sale(self, sale_id: str) -> None:
+        await self._write(self.service.revert_sale, sale_id)
+
+    async def get_car_info(self, vin: str) -> Optional[CarFullInfo]:
+        return await self._read(self.service.get_car_info, vin)
+
+    async def get_cars(self, status: str) -> List[Car]:
+        return await self._read(self.service.get_cars, status)
+
+    async def top_models_by_sales(self, k: int = 3) -> list[ModelSaleStats]:
+        return await self._read(self.service.top_models_by_sales, k)
+
+    async def aclose(self) -> None:
+        if self._write_task is not None:
+            await self._queue.put(None)
+            await self._write_task
+            self._write_task = None
+        self._readers.shutdown()
+        self._writer.shutdown()
+
+    async def __aenter__(self) -> "AsyncCarService":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
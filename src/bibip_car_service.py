@@ -1,114 +1,1038 @@
+import bisect
+import heapq
+import os
+import threading
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
 from decimal import Decimal
-from typing import List, Optional
+from typing import TYPE_CHECKING, Callable, Iterator, List, NamedTuple, Optional
+
 from models import Car, Model, Sale, CarFullInfo, CarStatus, ModelSaleStats
+from cache import CACHE_SIZE, LRUCache
+from ingest import BATCH_SIZE, BulkLoadError, Source, validated_batches
+from journal import Journal
+from leaderboard import SalesLeaderboard
+from locking import ServiceLock
+from metrics import Metrics, ProfileHook, instrumented
+from records import CarRecord, ModelRecord, Record, SaleRecord, to_scaled
+from sharding import ShardedTable, ShardPool, existing_shards, shard_sales_by_model
+from storage import (LINE_LEN, SCHEMA_VERSION, BatchItem, HashIndex, RecordFile, SortedIndex, Table, WriteBatch,
+                     datetime_key, check_index_key, check_index_keys, money_key, read_meta, write_meta)
+
+if TYPE_CHECKING:
+    from analytics import ColumnarSnapshot
+
+_MAX_KEY_CHAR = "\U0010ffff"  # больше любого символа VIN, граница диапазона статуса
+
+# Уплотнение файла запускается, когда удалённых записей больше этой доли
+COMPACT_DEAD_RATIO = 0.3
+COMPACT_MIN_DEAD = 1000
+
+ITER_CHUNK = 256  # сколько машин iter_cars читает за один захват блокировки
+
+
+class _IndexChanges(NamedTuple):
+    records: list[tuple[BatchItem, Record | None, Record | None]]  # изменение, прежняя и новая запись
+    removed: dict[HashIndex | SortedIndex, list[tuple[str, int]]]  # индекс -> (ключ, номер записи)
+    added: dict[HashIndex | SortedIndex, list[tuple[str, int]]]
+    sales: Counter  # id модели -> изменение числа продаж
+
+
+class _CompactCopy(NamedTuple):
+    epoch: int
+    journal_at: int  # размер журнала в момент копии: дальше — изменения, которых копия не видела
+    copied: list[int]  # число строк каждого шарда в момент копии
+    live: list[array]  # прежние номера живых строк шарда по порядку; новый номер — позиция в списке
+    entries: list[list[tuple[str, int]]]  # записи индексов таблицы по копии
+
+
+def _status_key(status: str, key: str) -> str:
+    return f"{status}|{key}"
+
+
+def _values(entries: Iterator[tuple[str, int]], prefix_len: int) -> Iterator[tuple[str, int]]:
+    # Записи индекса без префикса ключа: (значение, номер строки)
+    for key, line_no in entries:
+        yield key[prefix_len:], line_no
+
 
 class CarService:
-    def __init__(self, rood_dir) -> None:
-        self.models: List[Model] = []  # Список для хранения моделей
-        self.cars: List[Car] = []       # Список для хранения автомобилей
-        self.sales: List[Sale] = []      # Список для хранения продаж
+    """Сервис учёта машин над файлами в root_dir.
+
+    Один экземпляр можно использовать из нескольких потоков, а один каталог — из
+    нескольких процессов. Чтения идут параллельно под блокировкой читателей,
+    изменения выполняются по одному под блокировкой писателя (см. locking.ServiceLock).
+    Перед операцией экземпляр догоняет изменения других процессов: читает их записи
+    журнала, а после контрольной точки или уплотнения — заново читает файлы.
+
+    Машины и продажи можно разбить на shards файлов по хешу VIN (продажа лежит в шарде
+    своей машины). Число шардов задаётся при создании каталога и хранится в meta.json.
+    """
+
+    def __init__(
+        self, root_dir: str, info_cache_size: int = CACHE_SIZE, metrics: bool = False, shards: Optional[int] = None
+    ) -> None:
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        # Метрики выключены по умолчанию; profile_hook(операция, секунды) вызывается
+        # после каждой публичной операции, если задан
+        self._metrics: Metrics | None = None
+        self.profile_hook: ProfileHook | None = None
+        self._lock = ServiceLock(os.path.join(root_dir, "lock"))
+
+        # Пока открывается один процесс, другие каталог не меняют
+        with self._lock.write():
+            meta = read_meta(root_dir)
+            schema, line_len = meta.get("schema", SCHEMA_VERSION), meta.get("line_len", LINE_LEN)
+            if (schema, line_len) != (SCHEMA_VERSION, LINE_LEN):
+                raise ValueError(f"Directory {root_dir} has schema {schema} with {line_len}-byte records, "
+                                 f"expected schema {SCHEMA_VERSION} with {LINE_LEN}-byte records")
+            # Без meta (или в каталоге до шардирования) число шардов видно по файлам машин
+            stored_shards = meta.get("shards") or existing_shards(root_dir, "cars")
+            if stored_shards is not None and shards is not None and shards != stored_shards:
+                raise ValueError(f"Directory {root_dir} has {stored_shards} shards, resharding is not supported")
+            self._shards = stored_shards or shards or 1
+
+            # Данные хранятся в файлах models.txt, cars.txt и sales.txt (cars_0.txt, ... при
+            # шардировании). Строки читаются в записи со __slots__ (records), модели pydantic
+            # строятся только для результатов публичных методов
+            self._models: ShardedTable[ModelRecord] = ShardedTable(root_dir, "models", ModelRecord)
+            self._cars: ShardedTable[CarRecord] = ShardedTable(root_dir, "cars", CarRecord, self._shards)
+            self._sales: ShardedTable[SaleRecord] = ShardedTable(root_dir, "sales", SaleRecord, self._shards)
+            # Полные проходы по шардам (рейтинг при восстановлении, снимок для аналитики)
+            self._shard_pool = ShardPool()
+            # Поток автоматического уплотнения продаж (см. revert_sale); уплотнения внутри
+            # процесса идут по одному
+            self._compactor: threading.Thread | None = None
+            self._compact_lock = threading.Lock()
+
+            # Все изменения файлов данных сначала пишутся в журнал
+            self._journal = Journal(os.path.join(root_dir, "journal.log"))
+            self._group_depth = 0
+
+            # Первичные индексы: ключ index() -> номер строки в файле.
+            # Хранятся отсортированными файлами, точечные запросы идут через словарь в памяти.
+            self._models_index = self._open_index("models_index")
+            self._cars_index = self._open_index("cars_index")
+            self._sales_index = self._open_index("sales_index", unique=False)  # у машины может быть несколько продаж
+            # Вторичный индекс продаж по номеру продажи
+            self._sales_number_index = self._open_index("sales_number_index")
+            # Вторичный индекс машин по статусу: ключ "статус|VIN", внутри статуса машины упорядочены по VIN
+            self._status_index = SortedIndex(os.path.join(root_dir, "cars_status_index.txt"))
+            # Упорядоченные индексы для запросов по диапазону. Ключи машин — "статус|значение",
+            # чтобы фильтр по статусу не читал машины с другим статусом
+            self._date_start_index = SortedIndex(os.path.join(root_dir, "cars_date_start_index.txt"))
+            self._price_index = SortedIndex(os.path.join(root_dir, "cars_price_index.txt"))
+            self._sales_date_index = SortedIndex(os.path.join(root_dir, "sales_date_index.txt"))
+            self._record_indexes = self._build_record_indexes()
+            # Индексы, которых ещё нет на диске (каталог от прошлой версии), строятся по данным
+            missing_indexes = [index for index in self._indexes() if not os.path.exists(self._index_path(index))]
+
+            # Счётчики продаж по моделям для top_models_by_sales
+            self._leaderboard = SalesLeaderboard(os.path.join(root_dir, "model_sales.json"))
+
+            # Готовые CarFullInfo по VIN с меткой id модели. Записи убирает _index_writes()
+            # при изменении машины, её продаж или модели
+            self.info_cache: LRUCache[str, CarFullInfo] = LRUCache(info_cache_size)
+            if metrics:
+                self.enable_metrics()
+
+            # Эпоха и прочитанная часть журнала — то, насколько состояние в памяти
+            # отражает изменения других процессов
+            self._epoch = self._lock.read_state()[0]
+            self._journal_offset = 0
+
+            # Если прошлый сеанс не был корректно закрыт (или каталог сейчас меняет
+            # другой процесс), повторяем операции из журнала, а индексы, которые могли
+            # отстать от данных, строим заново. Файлы, размер которых не совпадает с
+            # записанным в контрольной точке, тоже считаются недописанными
+            counts = meta.get("counts", {})
+            self._clean = bool(meta.get("clean")) and all(
+                counts.get(table.name, len(table)) == len(table) for table in self._tables())
+            if self._clean:
+                for table in self._tables():
+                    table.dead = meta.get("dead", {}).get(table.name, 0)
+                if not self._leaderboard.load():
+                    self._rebuild_leaderboard()
+                if missing_indexes and any(len(table) for table in self._tables()):
+                    self._rebuild_indexes()
+                    self.flush()
+            else:
+                self._recover()
+                self._rebuild_leaderboard()
+                # Контрольная точка с новой эпохой: другие процессы перечитают файлы
+                self.flush()
+
+    def _tables(self) -> tuple[Table, ...]:
+        return *self._models, *self._cars, *self._sales
+
+    def _indexes(self) -> tuple[HashIndex | SortedIndex, ...]:
+        return (self._models_index, self._cars_index, self._sales_index, self._sales_number_index,
+                self._status_index, self._date_start_index, self._price_index, self._sales_date_index)
+
+    @staticmethod
+    def _index_path(index: HashIndex | SortedIndex) -> str:
+        return index.sorted.path if isinstance(index, HashIndex) else index.path
+
+    def _table_indexes(self, table: Table | ShardedTable) -> list[tuple[HashIndex | SortedIndex, Callable]]:
+        # Индексы, которые ссылаются на записи таблицы (или любого её шарда), и функции получения ключа
+        return self._record_indexes[table.record_cls]
+
+    def _build_record_indexes(self) -> dict[type, list[tuple[HashIndex | SortedIndex, Callable]]]:
+        # Строится один раз при открытии: _index_changes обращается к нему на каждую запись
+        return {
+            ModelRecord: [(self._models_index, ModelRecord.index)],
+            CarRecord: [(self._cars_index, CarRecord.index),
+                        (self._status_index, lambda car: _status_key(car.status, car.vin)),
+                        (self._date_start_index, lambda car: _status_key(car.status, datetime_key(car.date_start))),
+                        (self._price_index, lambda car: _status_key(car.status, money_key(car.price_units, car.price_exp)))],
+            SaleRecord: [(self._sales_index, SaleRecord.index),
+                         (self._sales_number_index, lambda sale: sale.sales_number),
+                         (self._sales_date_index, lambda sale: datetime_key(sale.sales_date))],
+        }
+
+    def _open_index(self, name: str, unique: bool = True) -> HashIndex:
+        return HashIndex(SortedIndex(os.path.join(self.root_dir, f"{name}.txt")), unique=unique)
+
+    def _recover(self) -> None:
+        tables = {table.name: table for table in self._tables()}
+        for entry in self._journal.replay():
+            # Новая строка — последнее поле изменения
+            for table_name, line_no, *_, line in entry["writes"]:
+                tables[table_name].records.put(line_no, line)
+        for table in self._tables():
+            table.flush(sync=True)
+        # Журнал очищает следующая контрольная точка: она же сообщит другим
+        # процессам, до какого места журнал был прочитан
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self) -> None:
+        # Один проход по файлу на шард; в памяти остаются только пары (ключ, номер записи)
+        for sharded in (self._models, self._cars, self._sales):
+            indexes = self._table_indexes(sharded)
+            entries: list[list[tuple[str, int]]] = [[] for _ in indexes]
+            for table in sharded:
+                live = 0
+                for line_no, record in table.scan():
+                    row = table.row(line_no)
+                    for (_, key), index_entries in zip(indexes, entries):
+                        index_entries.append((key(record), row))
+                    live += 1
+                table.dead = len(table) - live
+            for (index, _), index_entries in zip(indexes, entries):
+                index.rebuild(index_entries)
+
+    def _rebuild_leaderboard(self) -> None:
+        self._leaderboard.clear()
+        # Продажи считаются по шардам независимо: машина продажи всегда в том же шарде
+        args = [(cars.path, sales.path) for cars, sales in zip(self._cars, self._sales)]
+        counts: Counter = Counter()
+        for part in self._map_shards(shard_sales_by_model, args):
+            counts.update(part)
+        for model_id, count in sorted(counts.items()):
+            self._count_model_sales(model_id, count)
+
+    def _map_shards(self, fn: Callable, args: list[tuple]) -> list:
+        # Процессы пула читают файлы шардов сами, поэтому свои изменения сначала переносятся в файлы
+        if self._lock.is_writer():
+            self._sync()
+        return self._shard_pool.map(fn, args, len(self._cars) + len(self._sales))
+
+    def _count_model_sales(self, model_id: int, delta: int) -> None:
+        # Продажи считаются и для модели, которой ещё нет; название модели нужно рейтингу
+        # для порядка при равном числе продаж, его задаёт add_model
+        if self._leaderboard.knows(model_id):
+            self._leaderboard.increment(model_id, delta)
+            return
+        model = self._find_model(model_id)
+        self._leaderboard.increment(model_id, delta, model.name if model else None)
+
+    def _index_writes(self, items: list[BatchItem]) -> None:
+        """Переносит изменения строк в индексы, счётчики удалённых записей и рейтинг.
+
+        Работает одинаково для своих операций и для записей журнала других процессов.
+        """
+        self._apply_index_changes(self._index_changes(items))
+
+    def _index_changes(self, items: list[BatchItem]) -> _IndexChanges:
+        # Только вычисляет изменения индексов и проверяет новые ключи, ничего не меняя:
+        # так операцию можно отвергнуть до записи в журнал
+        changes = _IndexChanges([], {}, {}, Counter())
+        # Машины из этой же операции (и прежние, и новые образы): продаже не нужно искать
+        # свою в файле, в том числе когда машина с продажами переезжает в другой шард
+        cars: dict[str, CarRecord] = {}
+        sales: list[tuple[SaleRecord, int]] = []  # добавленные и удалённые продажи
+        # Новые записи по таблицам: их ключи собираются сразу списком на индекс, без
+        # сравнения с прежней записью (основная часть пакетной загрузки)
+        appended: dict[Table, list[tuple[int, Record]]] = {}
+        for item in items:
+            if item.old_record is not None:
+                old = item.old_record
+            else:
+                old = item.table.decode(item.old) if item.old else None
+            new = item.record if item.record is not None else item.table.decode(item.new)
+            changes.records.append((item, old, new))
+            if item.table.record_cls is CarRecord:
+                for car in (old, new):
+                    if car is not None:
+                        cars[car.vin] = car
+            elif item.table.record_cls is SaleRecord and (old is None) != (new is None):
+                sales.append((new, 1) if new is not None else (old, -1))
+
+            row = item.table.row(item.line_no)
+            if old is None:
+                if new is not None:
+                    appended.setdefault(item.table, []).append((row, new))
+                continue
+            for index, key in self._table_indexes(item.table):
+                old_key = key(old)
+                new_key = key(new) if new is not None else None
+                if old_key == new_key:
+                    continue
+                changes.removed.setdefault(index, []).append((old_key, row))
+                if new_key is not None:
+                    changes.added.setdefault(index, []).append((new_key, row))
+
+        for table, rows in appended.items():
+            for index, key in self._table_indexes(table):
+                changes.added.setdefault(index, []).extend([(key(record), row) for row, record in rows])
+        # Каждый новый ключ проверяется один раз; индексы и файл индекса его уже не проверяют
+        for entries in changes.added.values():
+            check_index_keys(key for key, _ in entries)
+
+        for sale, delta in sales:
+            car = cars.get(sale.car_vin)
+            if car is None:
+                found = self._find_car(sale.car_vin)
+                car = found[1] if found else None
+            if car is not None:
+                changes.sales[car.model] += delta
+        return changes
+
+    def _apply_index_changes(self, changes: _IndexChanges) -> None:
+        for index, entries in changes.removed.items():
+            if len(entries) == 1:
+                index.remove(*entries[0])
+            else:
+                index.remove_many(entries)
+        for index, entries in changes.added.items():
+            if len(entries) == 1:
+                index.add(*entries[0])
+            else:
+                index.add_many(entries)
+
+        stale: list[str] = []  # VIN машин, сведения о которых в кэше устарели
+        for item, old, new in changes.records:
+            for record in (old, new):
+                if record is None:
+                    continue
+                if item.table.record_cls is CarRecord:
+                    stale.append(record.vin)
+                elif item.table.record_cls is SaleRecord:
+                    stale.append(record.car_vin)
+                else:
+                    self.info_cache.invalidate_tag(record.id)
+
+            was_deleted = bool(item.old) and old is None
+            item.table.dead += (new is None) - was_deleted
+            if item.table.record_cls is ModelRecord and new is not None:
+                # Продажи модели могли быть посчитаны до её добавления
+                self._leaderboard.set_name(new.id, new.name)
+        self.info_cache.invalidate_many(stale)
+        for model_id, delta in changes.sales.items():
+            if delta:
+                self._count_model_sales(model_id, delta)
+
+    def _begin_write(self) -> None:
+        # Перед первым изменением после flush() помечаем каталог как "грязный".
+        # Число удалённых записей сохраняется: с него другие процессы начинают
+        # повторять журнал
+        if self._clean:
+            self._write_meta(clean=False)
+            self._clean = False
+
+    def _write_meta(self, clean: bool) -> None:
+        write_meta(self.root_dir, {
+            "schema": SCHEMA_VERSION,
+            "line_len": LINE_LEN,
+            "clean": clean,
+            "shards": self._shards,
+            "counts": {table.name: len(table) for table in self._tables()},
+            "dead": {table.name: table.dead for table in self._tables()},
+        })
+
+    def _commit(self, op: str, batch: WriteBatch, durable: bool = False) -> None:
+        """Записывает операцию в журнал, подготавливает её изменения в таблицах и индексах.
+
+        На диске операция фиксируется при выходе из _writing() (см. там). Пакеты массовой
+        загрузки (durable=True) вне group_commit() фиксируются сразу, чтобы подготовленные
+        строки не копились в памяти. Всё, что может отвергнуть операцию (ширина строк, длина
+        ключей индексов), проверяется до записи в журнал: попавшая в журнал операция
+        применяется к файлам и индексам целиком.
+        """
+        for item in batch.items:
+            item.table.records.check(item.new)
+        changes = self._index_changes(batch.items)
+        self._begin_write()
+        lsn = self._journal.append(op, [(item.table.name, item.line_no, item.old, item.new) for item in batch.items])
+        for item in batch.items:
+            item.table.records.stage(item.line_no, item.new, lsn)
+        self._apply_index_changes(changes)
+        if durable and not self._group_depth:
+            self._sync(lsn)
+
+    def _sync(self, lsn: Optional[int] = None) -> None:
+        self._journal.sync(lsn)
+        for table in self._tables():
+            table.records.apply(self._journal.durable_lsn)
 
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        # Блокировка писателя; при первом входе — догнать другие процессы, при выходе
+        # все изменения уже в журнале на диске. Если блокировку ждёт другой поток, она
+        # передаётся ему до fsync, а fsync ждём уже вне блокировки: потоки, пишущие
+        # одновременно, делят один fsync журнала (Journal.sync). Последний писатель
+        # очереди сам фиксирует журнал и переносит строки в файлы данных, и только
+        # после этого блокировку получают читатели и другие процессы
+        wait_lsn = None
+        with self._lock.write() as outermost:
+            if outermost:
+                self._catch_up()
+            try:
+                yield
+            finally:
+                if outermost:
+                    if self._lock.has_waiting_writers():
+                        wait_lsn = self._journal.last_lsn
+                    else:
+                        self._sync()
+                    self._journal_offset = self._journal.size()
+        if wait_lsn is not None:
+            self._journal.sync(wait_lsn)
+
+    @contextmanager
+    def _reading(self) -> Iterator[None]:
+        if self._lock.is_writer():
+            yield
+            return
+        while True:
+            with self._lock.read():
+                if not self._has_foreign_changes():
+                    yield
+                    return
+            # Догоняем под блокировкой писателя и пробуем снова
+            with self._writing():
+                pass
+
+    def _has_foreign_changes(self) -> bool:
+        return self._lock.read_state()[0] != self._epoch or self._journal.size() != self._journal_offset
+
+    def _catch_up(self) -> None:
+        if not self._has_foreign_changes():
+            return
+        epoch, truncated_at = self._lock.read_state()
+        if epoch != self._epoch:
+            if epoch == self._epoch + 1 and truncated_at == self._journal_offset:
+                # Была только контрольная точка, а все её изменения у нас уже есть
+                self._journal_offset = 0
+            else:
+                self._reload()
+            self._epoch = epoch
+        self._clean = bool(read_meta(self.root_dir).get("clean"))
+
+        tables = {table.name: table for table in self._tables()}
+        for table in self._tables():
+            table.records.refresh()
+        for entry in self._journal.replay(self._journal_offset):
+            self._index_writes([
+                BatchItem(tables[table_name], line_no, old, new, None)
+                for table_name, line_no, old, new in entry["writes"]
+            ])
+        self._journal_offset = self._journal.size()
+
+    def _reload(self) -> None:
+        # Другой процесс переписал индексы или файлы данных: состояние на момент его
+        # контрольной точки читается с диска, остальное догоняется по журналу
+        meta = read_meta(self.root_dir)
+        for table in self._tables():
+            table.reopen()
+            table.dead = meta.get("dead", {}).get(table.name, 0)
+        for index in self._indexes():
+            index.reload()
+        if not self._leaderboard.load():
+            self._leaderboard.clear()
+        self.info_cache.clear()
+        self._journal_offset = 0
+
+    @contextmanager
+    def group_commit(self) -> Iterator["CarService"]:
+        """Операции внутри блока фиксируются в журнале одним общим fsync при выходе.
+
+        Весь блок выполняется под блокировкой писателя.
+        """
+        with self._writing():
+            self._group_depth += 1
+            try:
+                yield self
+            finally:
+                self._group_depth -= 1
+                if not self._group_depth:
+                    self._sync()
+
+    def _find_car(self, vin: str) -> Optional[tuple[int, CarRecord]]:
+        row = self._cars_index.get(vin)
+        if row is None:
+            return None
+        return row, self._cars.get(row)
+
+    def _find_model(self, model_id: int) -> Optional[ModelRecord]:
+        row = self._models_index.get(str(model_id))
+        return self._models.get(row) if row is not None else None
+
+    def _sales_for_car(self, vin: str) -> List[SaleRecord]:
+        return [self._sales.get(row) for row in self._sales_index.lookup(vin)]
+
+    @staticmethod
+    def _rewrite(batch: WriteBatch, sharded: ShardedTable, row: int, record: Record, key: str) -> None:
+        # Запись с ключом шардирования key: на месте, если шард тот же, иначе переезд —
+        # старая строка становится надгробием, запись дописывается в новый шард
+        table, line_no = sharded.locate(row)
+        target = sharded.for_key(key)
+        if target is table:
+            batch.update(table, line_no, record)
+        else:
+            batch.delete(table, line_no, record)
+            batch.append(target, record)
+
+    @instrumented
     def add_car(self, car: Car) -> Car:
-        self.cars.append(car)
+        with self._writing():
+            if car.index() in self._cars_index:
+                raise ValueError(f"Car with VIN {car.vin} already exists")
+            batch = WriteBatch()
+            batch.append(self._cars.for_key(car.vin), CarRecord.from_model(car))
+            self._commit("add_car", batch)
         return car
 
+    @instrumented
     def add_model(self, model: Model) -> Model:
-        self.models.append(model)
+        with self._writing():
+            if model.index() in self._models_index:
+                raise ValueError(f"Model with ID {model.id} already exists")
+            batch = WriteBatch()
+            batch.append(self._models.for_key(model.index()), ModelRecord.from_model(model))
+            self._commit("add_model", batch)
         return model
 
-    def sell_car(self, sale: Sale) -> Car:
-        # Проверка наличия автомобиля
-        car = next((car for car in self.cars if car.vin == sale.car_vin), None)
-        if car is None:
-            raise ValueError(f"Car with VIN {sale.car_vin} not found")
+    def _check_new_keys(self, index: HashIndex, keys: list[str], what: str) -> None:
+        seen = set()
+        for key in keys:
+            if key in seen or key in index:
+                raise ValueError(f"{what} {key} already exists")
+            seen.add(key)
 
-        # Запись продажи
-        self.sales.append(sale)
+    def _bulk_load(self, source: Source, model_cls: type, batch_size: int, load: Callable[[list], None]) -> int:
+        """Загружает выгрузку пачками по batch_size строк, load() записывает одну пачку.
 
-        # Обновление статуса автомобиля
-        car.status = CarStatus.sold
+        Каждая пачка — одна запись журнала и один fsync. При ошибке в пачке N пачки
+        1..N-1 остаются загруженными: исключение BulkLoadError сообщает их число строк.
+        """
+        loaded = 0
+        with self._writing():
+            try:
+                for batch in validated_batches(source, model_cls, batch_size):
+                    load(batch)
+                    loaded += len(batch)
+            except ValueError as error:
+                raise BulkLoadError(loaded, error) from error
+            # Накопленные записи индексов сливаются с файлами один раз в конце загрузки
+            self.flush()
+        return loaded
 
-        return car
+    @instrumented
+    def bulk_load_models(self, source: Source, batch_size: int = BATCH_SIZE) -> int:
+        return self._bulk_load(source, Model, batch_size, self._load_models)
+
+    @instrumented
+    def bulk_load_cars(self, source: Source, batch_size: int = BATCH_SIZE) -> int:
+        return self._bulk_load(source, Car, batch_size, self._load_cars)
+
+    @instrumented
+    def bulk_load_sales(self, source: Source, batch_size: int = BATCH_SIZE) -> int:
+        return self._bulk_load(source, Sale, batch_size, self._load_sales)
+
+    def _load_models(self, models: list[Model]) -> None:
+        self._check_new_keys(self._models_index, [model.index() for model in models], "Model with ID")
+        batch = WriteBatch()
+        for model in models:
+            batch.append(self._models.for_key(model.index()), ModelRecord.from_model(model))
+        self._commit("bulk_load_models", batch, durable=True)
+
+    def _load_cars(self, cars: list[Car]) -> None:
+        self._check_new_keys(self._cars_index, [car.index() for car in cars], "Car with VIN")
+        batch = WriteBatch()
+        for car in cars:
+            batch.append(self._cars.for_key(car.vin), CarRecord.from_model(car))
+        self._commit("bulk_load_cars", batch, durable=True)
 
+    def _load_sales(self, sales: list[Sale]) -> None:
+        self._check_new_keys(self._sales_number_index, [sale.sales_number for sale in sales], "Sale with ID")
+        # Строка машины читается один раз: она же уходит в журнал как прежняя
+        cars: dict[str, tuple[int, str, CarRecord]] = {}
+        for sale in sales:
+            if sale.car_vin in cars:
+                raise ValueError(f"Car with VIN {sale.car_vin} is already sold")
+            row = self._cars_index.get(sale.car_vin)
+            if row is None:
+                raise ValueError(f"Car with VIN {sale.car_vin} not found")
+            table, line_no = self._cars.locate(row)
+            line = table.records.read(line_no)
+            car = table.decode(line)
+            if car.status == CarStatus.sold:
+                raise ValueError(f"Car with VIN {sale.car_vin} is already sold")
+            cars[sale.car_vin] = (row, line, car)
+
+        batch = WriteBatch()
+        for sale in sales:
+            batch.append(self._sales.for_key(sale.car_vin), SaleRecord.from_model(sale))
+        for row, line, car in sorted(cars.values(), key=lambda found: found[0]):
+            sold = CarRecord(car.vin, car.model, car.price_units, car.price_exp, car.date_start, CarStatus.sold)
+            batch.update(*self._cars.locate(row), sold, (line, car))
+        self._commit("bulk_load_sales", batch, durable=True)
+
+    @instrumented
+    def sell_car(self, sale: Sale) -> Car:
+        with self._writing():
+            # Проверка наличия автомобиля; проверки и запись идут под одной блокировкой,
+            # поэтому одну машину нельзя продать дважды
+            found = self._find_car(sale.car_vin)
+            if found is None:
+                raise ValueError(f"Car with VIN {sale.car_vin} not found")
+            if sale.sales_number in self._sales_number_index:
+                raise ValueError(f"Sale with ID {sale.sales_number} already exists")
+            row, car = found
+            if car.status == CarStatus.sold:
+                raise ValueError(f"Car with VIN {sale.car_vin} is already sold")
+
+            # Продажа и новый статус автомобиля фиксируются одной записью журнала
+            batch = WriteBatch()
+            batch.append(self._sales.for_key(sale.car_vin), SaleRecord.from_model(sale))
+            car.status = CarStatus.sold
+            batch.update(*self._cars.locate(row), car)
+            self._commit("sell_car", batch)
+        return car.to_model()
+
+    @instrumented
     def get_car_info(self, vin: str) -> Optional[CarFullInfo]:
-        car = next((car for car in self.cars if car.vin == vin), None)
-        if not car:
-            return None
+        with self._reading():
+            # Кэш меняется только вместе с данными под блокировкой писателя, поэтому
+            # значение, найденное или положенное под блокировкой читателя, актуально
+            info = self.info_cache.get(vin)
+            if info is not None:
+                return info
 
-        model = next((model for model in self.models if model.id == car.model), None)
-        sales_for_car = [sale for sale in self.sales if sale.car_vin == vin]
+            found = self._find_car(vin)
+            if not found:
+                return None
+            _, car = found
 
-        sales_date = sales_for_car[0].sales_date if sales_for_car else None
-        sales_cost = sales_for_car[0].cost if sales_for_car else None
+            model = self._find_model(car.model)
+            sales_for_car = self._sales_for_car(vin)
 
-        return CarFullInfo(
-            vin=car.vin,
-            car_model_name=model.name if model else "Unknown",
-            car_model_brand=model.brand if model else "Unknown",
-            price=car.price,
-            date_start=car.date_start,
-            status=car.status,
-            sales_date=sales_date,
-            sales_cost=sales_cost,
-        )
+            sales_date = sales_for_car[0].sales_date if sales_for_car else None
+            sales_cost = sales_for_car[0].cost if sales_for_car else None
 
+            # Поля уже проверены при записи, поэтому без повторной валидации
+            info = CarFullInfo.model_construct(
+                vin=car.vin,
+                car_model_name=model.name if model else "Unknown",
+                car_model_brand=model.brand if model else "Unknown",
+                price=car.price,
+                date_start=car.date_start,
+                status=car.status,
+                sales_date=sales_date,
+                sales_cost=sales_cost,
+            )
+            self.info_cache.put(vin, info, tag=car.model)
+            return info
+
+    @instrumented
     def get_cars(self, status: str) -> List[Car]:
-        return [car for car in self.cars if car.status == status]
+        # Машины в порядке добавления (при нескольких шардах — внутри шарда); читаются
+        # только строки с нужным статусом
+        with self._reading():
+            rows = sorted(row for _, row in self._status_items(status))
+            return [self._cars.get(row).to_model() for row in rows]
+
+    def iter_cars(
+        self, status: str, limit: Optional[int] = None, offset: int = 0, after_vin: Optional[str] = None
+    ) -> Iterator[Car]:
+        """Машины с указанным статусом в порядке VIN, лениво.
+
+        Страницу можно задать смещением offset или курсором after_vin — последним VIN
+        предыдущей страницы. Машины читаются частями по ITER_CHUNK, блокировка между
+        частями не удерживается.
+        """
+        remaining = limit
+        cursor = after_vin
+        while remaining is None or remaining > 0:
+            chunk_size = ITER_CHUNK if remaining is None else min(ITER_CHUNK, remaining)
+            chunk = []
+            with self._reading():
+                for key, line_no in self._status_items(status, cursor):
+                    cursor = key.partition("|")[2]
+                    if offset:
+                        offset -= 1
+                        continue
+                    chunk.append(self._cars.get(line_no).to_model())
+                    if len(chunk) == chunk_size:
+                        break
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def _status_items(self, status: str, after_vin: Optional[str] = None) -> Iterator[tuple[str, int]]:
+        start = _status_key(status, after_vin or "")
+        for key, line_no in self._status_index.items(start, _status_key(status, _MAX_KEY_CHAR)):
+            if after_vin is not None and key == start:
+                continue
+            yield key, line_no
+
+    def cars_by_date_start(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None, status: Optional[str] = None
+    ) -> Iterator[Car]:
+        """Машины с date_start из [start, end) в порядке даты, лениво.
+
+        Граница None означает отсутствие ограничения, status — необязательный фильтр.
+        """
+        return self._iter_range(self._cars, self._date_start_index, self._status_prefixes(status),
+                                datetime_key(start) if start is not None else None,
+                                datetime_key(end) if end is not None else None)
+
+    def cars_by_price(
+        self, min_price: Optional[Decimal] = None, max_price: Optional[Decimal] = None, status: Optional[str] = None
+    ) -> Iterator[Car]:
+        """Машины с ценой из [min_price, max_price] (обе границы включены) по возрастанию цены, лениво."""
+        # Ключи больших сумм с теми же сотыми продолжают ключ max_price цифрами, а "!" меньше
+        # цифр, но больше пробела, которым ключи дополняются в файле индекса
+        return self._iter_range(self._cars, self._price_index, self._status_prefixes(status),
+                                money_key(*to_scaled(min_price)) if min_price is not None else None,
+                                money_key(*to_scaled(max_price)) + "!" if max_price is not None else None)
 
+    def sales_by_date(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Iterator[Sale]:
+        """Продажи с sales_date из [start, end) в порядке даты, лениво."""
+        return self._iter_range(self._sales, self._sales_date_index, [""],
+                                datetime_key(start) if start is not None else None,
+                                datetime_key(end) if end is not None else None)
+
+    @staticmethod
+    def _status_prefixes(status: Optional[str]) -> list[str]:
+        statuses = list(CarStatus) if status is None else [status]
+        return [_status_key(name, "") for name in statuses]
+
+    def _iter_range(
+        self, table: ShardedTable, index: SortedIndex, prefixes: list[str], low: Optional[str], high: Optional[str]
+    ) -> Iterator[Car | Sale]:
+        """Записи table, значения ключей которых (без префикса) лежат в [low, high).
+
+        Диапазоны всех префиксов сливаются по значению. Записи читаются частями по
+        ITER_CHUNK; следующая часть продолжается сразу после последней выданной записи
+        (поиском по ключу и номеру строки), блокировка между частями не удерживается.
+        """
+        cursor: Optional[tuple[str, int]] = None  # (значение, номер строки) последней записи
+        while True:
+            chunk = []
+            with self._reading():
+                streams = [
+                    _values(index.items(prefix + (low or ""), prefix + (high or _MAX_KEY_CHAR),
+                                        after=(prefix + cursor[0], cursor[1]) if cursor is not None else None),
+                            len(prefix))
+                    for prefix in prefixes
+                ]
+                for value, line_no in heapq.merge(*streams):
+                    if high is not None and value >= high:
+                        break
+                    chunk.append(table.get(line_no).to_model())
+                    cursor = value, line_no
+                    if len(chunk) == ITER_CHUNK:
+                        break
+            yield from chunk
+            if len(chunk) < ITER_CHUNK:
+                return
+
+    @instrumented
     def update_vin(self, old_vin: str, new_vin: str) -> None:
-        car = next((car for car in self.cars if car.vin == old_vin), None)
-        if car is None:
-            raise ValueError(f"Car with VIN {old_vin} not found")
-        
-        # Обновление VIN номера
-        car.vin = new_vin
-
-        # Обновление всех продаж, связанных с этим автомобилем
-        for sale in self.sales:
-            if sale.car_vin == old_vin:
+        """Меняет VIN машины и всех её продаж одной операцией.
+
+        Продажи находятся по индексу car_vin -> продажи, поэтому переименование читает и
+        переписывает только k продаж этой машины: O(log n + k). Новый VIN проверяется до
+        любых изменений, операция попадает в журнал и индексы целиком или не попадает вовсе.
+        """
+        with self._writing():
+            found = self._find_car(old_vin)
+            if found is None:
+                raise ValueError(f"Car with VIN {old_vin} not found")
+            if new_vin == old_vin:
+                # Как и раньше, переименование в тот же VIN ничего не меняет
+                return
+            if new_vin in self._cars_index:
+                raise ValueError(f"Car with VIN {new_vin} already exists")
+            check_index_key(new_vin)
+            row, car = found
+
+            # Новый VIN автомобиля и всех его продаж фиксируется одной записью журнала.
+            # Если новый VIN попадает в другой шард, машина и продажи переезжают туда вместе
+            batch = WriteBatch()
+            car.vin = new_vin
+            self._rewrite(batch, self._cars, row, car, new_vin)
+            for sale_row in self._sales_index.lookup(old_vin):
+                sale = self._sales.get(sale_row)
                 sale.car_vin = new_vin
+                self._rewrite(batch, self._sales, sale_row, sale, new_vin)
+            self._commit("update_vin", batch)
+
+    @instrumented
+    def revert_sale(self, sale_id: str) -> None:
+        with self._writing():
+            row = self._sales_number_index.get(sale_id)
+            if row is None:
+                raise ValueError(f"Sale with ID {sale_id} not found")
+            sale = self._sales.get(row)
+
+            # Удаление продажи и возврат статуса "Доступен" — одна запись журнала
+            batch = WriteBatch()
+            batch.delete(*self._sales.locate(row), sale)
+            car_found = self._find_car(sale.car_vin)
+            if car_found:
+                car_row, car = car_found
+                car.status = CarStatus.available
+                batch.update(*self._cars.locate(car_row), car)
+            self._commit("revert_sale", batch)
+
+            if self._sales.dead >= COMPACT_MIN_DEAD and self._sales.dead > COMPACT_DEAD_RATIO * len(self._sales):
+                # Уплотнение идёт в фоне, отмена продажи его не ждёт
+                if self._compactor is None or not self._compactor.is_alive():
+                    self._compactor = threading.Thread(
+                        target=self.compact, args=("sales",), name="bibip-compact", daemon=True)
+                    self._compactor.start()
+
+    @instrumented
+    def compact(self, table_name: str = "sales") -> int:
+        """Переписывает файлы таблицы (все шарды) и её индексы без удалённых записей.
+
+        Под блокировкой читателей запоминаются только размер журнала и число строк шардов;
+        копия строится без блокировки, чтения и изменения идут как обычно по старым файлам
+        и индексам. Блокировка писателя берётся только для подмены: изменения, записанные
+        в журнал после начала копии, переносятся в неё перед заменой файлов. Возвращает
+        число выброшенных записей.
+        """
+        sharded = next((table for table in (self._models, self._cars, self._sales) if table.name == table_name), None)
+        if sharded is None:
+            raise ValueError(f"Unknown table {table_name}")
+        with self._compact_lock:
+            with self._reading():
+                copy = self._start_copy(sharded)
+            self._copy_live(sharded, copy)
+            with self._writing():
+                if copy.epoch != self._epoch or not all(os.path.exists(table.compact_path) for table in sharded):
+                    # После начала копии журнал очищен контрольной точкой (или копию удалил
+                    # открывший каталог процесс): копия строится заново под блокировкой писателя
+                    copy = self._start_copy(sharded)
+                    self._copy_live(sharded, copy)
+                # Подготовленные изменения (внутри group_commit) переносятся в файлы и журнал
+                self._sync()
+                dead = self._copy_delta(sharded, copy)
+
+                # Контрольная точка до подмены: записи журнала ссылаются на старые номера строк,
+                # и восстановление после сбоя не должно повторять их на уплотнённых файлах.
+                # Каталог остаётся "грязным", пока не переписаны индексы: при сбое до этого
+                # индексы и рейтинг будут построены заново по файлам
+                self._begin_write()
+                for table in self._tables():
+                    table.flush(sync=True)
+                truncated_at = self._journal.size()
+                self._journal.reset()
+                self._epoch += 1
+                self._lock.write_state(self._epoch, truncated_at)
+                self._journal_offset = 0
+
+                for table, table_dead in zip(sharded, dead):
+                    table.swap(table.compact_path)
+                    table.dead = table_dead
+                for (index, _), entries in zip(self._table_indexes(sharded), copy.entries):
+                    index.rebuild(entries)
+                # Вместе с эпохой контрольной точки выше эпоха меняется дважды: другие процессы
+                # перечитают файлы, а не примут подмену за одну контрольную точку (см. _catch_up)
+                self.flush()
+        return sum(copy.copied) - sum(len(live) for live in copy.live)
+
+    def _start_copy(self, sharded: ShardedTable) -> _CompactCopy:
+        # Вызывается под блокировкой: все изменения до journal_at уже в файлах шардов
+        return _CompactCopy(self._epoch, self._journal.size(), [len(table) for table in sharded], [],
+                            [[] for _ in self._table_indexes(sharded)])
+
+    def _copy_live(self, sharded: ShardedTable, copy: _CompactCopy) -> None:
+        """Копирует живые записи первых copy.copied строк каждого шарда и собирает их записи индексов.
+
+        Может идти без блокировки: строку, которую меняют во время копии, копия видит в
+        одном из её состояний после journal_at, а итог по журналу переносит _copy_delta.
+        """
+        indexes = self._table_indexes(sharded)
+        for table, count in zip(sharded, copy.copied):
+            live = array("q")
+            for line_no, new_line, record in table.copy_live(table.compact_path, count):
+                row = table.row(new_line)
+                for (_, key), entries in zip(indexes, copy.entries):
+                    entries.append((key(record), row))
+                live.append(line_no)
+            copy.live.append(live)
+        # Сортировка тоже вне блокировки: при rebuild почти упорядоченный список сортируется за проход
+        for entries in copy.entries:
+            entries.sort()
+
+    def _copy_delta(self, sharded: ShardedTable, copy: _CompactCopy) -> list[int]:
+        """Переносит в копию изменения таблицы из журнала после copy.journal_at.
+
+        Записи индексов изменённых строк в copy.entries строятся заново по их последнему
+        состоянию; возвращает число удалённых записей в каждом шарде копии.
+        """
+        shards = {table.name: shard for shard, table in enumerate(sharded)}
+        indexes = self._table_indexes(sharded)
+        changed: list[dict[int, str]] = [{} for _ in sharded]  # новый номер строки -> последняя строка
+        files = [RecordFile(table.compact_path) for table in sharded]
+        try:
+            for entry in self._journal.replay(copy.journal_at):
+                for table_name, line_no, _, new in entry["writes"]:
+                    shard = shards.get(table_name)
+                    if shard is None:
+                        continue
+                    live = copy.live[shard]
+                    if line_no < copy.copied[shard]:
+                        new_line = bisect.bisect_left(live, line_no)
+                        if new_line == len(live) or live[new_line] != line_no:
+                            continue  # удалённая до копии строка больше не меняется
+                    else:
+                        # Строки, дописанные после начала копии, идут за живыми строками копии
+                        new_line = len(live) + line_no - copy.copied[shard]
+                    files[shard].put(new_line, new)
+                    changed[shard][new_line] = new
+            for records in files:
+                records.flush(sync=True)
+        finally:
+            for records in files:
+                records.close()
 
-    def revert_sale(self, sale_id: int) -> None:
-        sale = next((sale for sale in self.sales if sale.sales_number == sale_id), None)
-        if sale is None:
-            raise ValueError(f"Sale with ID {sale_id} not found")
+        # Копия могла застать изменённую строку в любом её состоянии, поэтому её записи
+        # индексов убираются целиком и добавляются по последней строке
+        rows = {table.row(new_line) for table, shard_changed in zip(sharded, changed) for new_line in shard_changed}
+        if rows:
+            for entries in copy.entries:
+                entries[:] = [index_entry for index_entry in entries if index_entry[1] not in rows]
+        dead = []
+        for table, shard_changed in zip(sharded, changed):
+            shard_dead = 0
+            for new_line, line in shard_changed.items():
+                record = table.decode(line)
+                if record is None:
+                    shard_dead += 1
+                    continue
+                row = table.row(new_line)
+                for (_, key), entries in zip(indexes, copy.entries):
+                    entries.append((key(record), row))
+            dead.append(shard_dead)
+        return dead
 
-        # Удаление продажи из списка
-        self.sales.remove(sale)
+    @instrumented
+    def top_models_by_sales(self, k: int = 3) -> list[ModelSaleStats]:
+        # Рейтинг уже упорядочен по (-продажи, название модели)
+        if k < 0:
+            raise ValueError(f"k must be non-negative, got {k}")
+        top_models = []
+        with self._reading():
+            for model_id, name, count in self._leaderboard.top(k):
+                model = self._find_model(model_id)
+                top_models.append(
+                    ModelSaleStats(car_model_name=name, brand=model.brand if model else "Unknown", sales_number=count))
+        return top_models
 
-        # Обновление статуса автомобиля на "Доступен"
-        car = next((car for car in self.cars if car.vin == sale.car_vin), None)
-        if car:
-            car.status = CarStatus.available  # Предполагаем, что статус "Доступен"
+    @instrumented
+    def snapshot(self) -> "ColumnarSnapshot":
+        """Столбцовый снимок данных для аналитики (см. analytics.SalesAnalytics)."""
+        # NumPy нужен только аналитике, поэтому импорт здесь
+        from analytics import ColumnarSnapshot, build_shard_snapshot
 
-     def top_models_by_sales(self) -> list[ModelSaleStats]:
+        with self._reading():
+            # Каждый шард с его продажами собирается отдельно (в пуле процессов, если
+            # данных много), затем столбцы склеиваются
+            models = [model for _, model in self._models.scan()]
+            args = [(models, cars.path, sales.path) for cars, sales in zip(self._cars, self._sales)]
+            return ColumnarSnapshot.concat(self._map_shards(build_shard_snapshot, args))
 
-            sales_count = {}
+    @instrumented
+    def flush(self) -> None:
+        # Контрольная точка: все изменения из журнала переносятся в файлы данных
+        # и сбрасываются на диск, после чего журнал очищается. Новая эпоха говорит
+        # другим процессам, что файлы индексов переписаны
+        with self._writing():
+            self._sync()
+            for table in self._tables():
+                table.flush(sync=True)
+            for index in self._indexes():
+                index.flush()
+            self._leaderboard.save()
+            truncated_at = self._journal.size()
+            self._journal.reset()
+            self._write_meta(clean=True)
+            self._clean = True
+            self._epoch += 1
+            self._lock.write_state(self._epoch, truncated_at)
+            self._journal_offset = 0
 
-            for sale in self.sales:
+    def enable_metrics(self, enabled: bool = True) -> None:
+        """Включает (с нуля) или выключает счётчики операций и ввода-вывода."""
+        self._metrics = Metrics() if enabled else None
+        for component in (*self._tables(), *self._indexes(), self._journal):
+            component.metrics = self._metrics
 
-                car = next(
-                    (car for car in self.cars if car.vin == sale.car_vin), None)
-                if car:
-                    model = next(
-                        (model for model in self.models if model.id == car.model), None)
-                    if model:
-                        if model.id not in sales_count:
-                            sales_count[model.id] = {
-                                'name': model.name, 'brand': model.brand, 'count': 0}
-                        sales_count[model.id]['count'] += 1
+    def stats(self) -> dict:
+        """Задержки публичных операций, счётчики ввода-вывода и кэша CarFullInfo.
 
-            # Преобразуем словарь в список
+        Операции и ввод-вывод считаются только при включённых метриках, кэш — всегда.
+        """
+        result = self._metrics.snapshot() if self._metrics is not None else {"operations": {}, "io": {}}
+        result["enabled"] = self._metrics is not None
+        result["cache"] = {
+            "size": len(self.info_cache),
+            "maxsize": self.info_cache.maxsize,
+            "hits": self.info_cache.hits,
+            "misses": self.info_cache.misses,
+            "evictions": self.info_cache.evictions,
+        }
+        return result
 
-            top_models = [
-                ModelSaleStats(
-                    car_model_name=data['name'], brand=data['brand'], sales_number=data['count'])
-                for data in sales_count.values()
-            ]
+    def reset_stats(self) -> None:
+        if self._metrics is not None:
+            self._metrics.reset()
+        self.info_cache.reset_counters()
 
-            # Сортируем по количеству продаж и по имени модели
+    def close(self) -> None:
+        if self._compactor is not None:
+            self._compactor.join()
+        self.flush()
+        for table in self._tables():
+            table.close()
+        for index in self._indexes():
+            index.close()
+        self._journal.close()
+        self._shard_pool.close()
+        self._lock.close()
 
-            top_models.sort(key=lambda x: (-x.sales_number, x.car_model_name))
+    def __enter__(self) -> "CarService":
+        return self
 
-            return top_models[:3]       
-    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
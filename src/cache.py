@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from typing import Generic, Hashable, Iterable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+CACHE_SIZE = 10_000
+
+
+class LRUCache(Generic[K, V]):
+    """Ограниченный кэш с вытеснением давно не использованных значений.
+
+    У значения может быть метка (например, id модели машины): invalidate_tag() убирает
+    все значения с этой меткой, не перебирая весь кэш. Кэш читают параллельные
+    читатели, поэтому все операции идут под своей блокировкой.
+    """
+
+    def __init__(self, maxsize: int = CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict[K, tuple[V, Hashable]] = OrderedDict()
+        self._tags: dict[Hashable, set[K]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: K, value: V, tag: Hashable = None) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (value, tag)
+            self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._discard(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def invalidate_many(self, keys: Iterable[K]) -> None:
+        # Одна блокировка на пачку ключей (пакетная загрузка)
+        with self._lock:
+            for key in keys:
+                self._discard(key)
+
+    def invalidate_tag(self, tag: Hashable) -> None:
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._discard(key)
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def _discard(self, key: K) -> None:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        keys = self._tags[entry[1]]
+        keys.discard(key)
+        if not keys:
+            del self._tags[entry[1]]
@@ -0,0 +1,61 @@
+import csv
+import json
+import os
+from functools import cache
+from itertools import islice
+from typing import Any, Iterable, Iterator, TypeVar
+
+from pydantic import BaseModel, TypeAdapter
+
+from storage import ENCODING
+
+BATCH_SIZE = 10_000
+
+T = TypeVar("T", bound=BaseModel)
+
+Source = str | os.PathLike | Iterable[Any]
+
+
+def read_rows(source: Source) -> Iterator[Any]:
+    """Строки выгрузки: из CSV/JSONL файла по пути или из переданного итерируемого объекта."""
+    if isinstance(source, (str, os.PathLike)):
+        yield from _read_file(os.fspath(source))
+    else:
+        yield from source
+
+
+def _read_file(path: str) -> Iterator[dict]:
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, newline="", encoding=ENCODING) as f:
+        if ext == ".csv":
+            yield from csv.DictReader(f)
+        elif ext in (".jsonl", ".ndjson"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Unsupported feed format: {path}")
+
+
+class BulkLoadError(ValueError):
+    """Ошибка в пачке массовой загрузки.
+
+    Пачки фиксируются по одной, поэтому строки предыдущих пачек уже загружены и
+    остаются в хранилище; их число — в loaded. Пачка с ошибкой не загружается целиком.
+    """
+
+    def __init__(self, loaded: int, error: Exception) -> None:
+        super().__init__(f"{error} (rows loaded before the error: {loaded})")
+        self.loaded = loaded
+
+
+@cache
+def _adapter(model_cls: type[T]) -> TypeAdapter[list[T]]:
+    return TypeAdapter(list[model_cls])
+
+
+def validated_batches(source: Source, model_cls: type[T], batch_size: int = BATCH_SIZE) -> Iterator[list[T]]:
+    # Пачка проверяется одним вызовом TypeAdapter, а не построением моделей по одной
+    rows = read_rows(source)
+    while batch := list(islice(rows, batch_size)):
+        yield _adapter(model_cls).validate_python(batch)
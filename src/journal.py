@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Iterator
+
+from metrics import Metrics
+from storage import ENCODING
+
+
+class Journal:
+    """Журнал упреждающей записи (write-ahead log) в корневом каталоге.
+
+    Каждая операция сервиса — одна строка "crc32 json" со всеми изменениями файлов
+    данных. Файлы данных меняются только после того, как строка журнала сброшена на
+    диск, поэтому после сбоя операция либо повторяется целиком, либо не видна вовсе.
+
+    sync() реализует групповую фиксацию: пока один поток выполняет fsync, остальные
+    дописывают свои записи и затем фиксируются следующим общим fsync.
+    """
+
+    def __init__(self, path: str, commit_delay: float = 0.0) -> None:
+        self.path = path
+        self.commit_delay = commit_delay  # пауза перед fsync, чтобы собрать группу побольше
+        self._file = open(path, "ab")
+        self._cond = threading.Condition()
+        self._last_lsn = 0
+        self._durable_lsn = 0
+        self._syncing = False
+        self.metrics: Metrics | None = None
+
+    @property
+    def last_lsn(self) -> int:
+        return self._last_lsn
+
+    @property
+    def durable_lsn(self) -> int:
+        return self._durable_lsn
+
+    def append(self, op: str, writes: list[tuple[str, int, str, str]]) -> int:
+        with self._cond:
+            lsn = self._last_lsn + 1
+            payload = json.dumps(
+                {"lsn": lsn, "op": op, "writes": writes}, ensure_ascii=False, separators=(",", ":")
+            ).encode(ENCODING)
+            line = b"%08x %s\n" % (zlib.crc32(payload), payload)
+            self._file.write(line)
+            if self.metrics is not None:
+                self.metrics.count(journal_bytes=len(line))
+            self._last_lsn = lsn
+            return lsn
+
+    def sync(self, lsn: int | None = None) -> None:
+        """Ждёт, пока запись lsn (по умолчанию последняя) окажется на диске."""
+        with self._cond:
+            lsn = self._last_lsn if lsn is None else lsn
+            while self._durable_lsn < lsn:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                try:
+                    self._cond.release()
+                    try:
+                        if self.commit_delay:
+                            time.sleep(self.commit_delay)
+                    finally:
+                        self._cond.acquire()
+                    target = self._last_lsn
+                    self._file.flush()
+                    self._cond.release()
+                    try:
+                        os.fsync(self._file.fileno())
+                    finally:
+                        self._cond.acquire()
+                    if self.metrics is not None:
+                        self.metrics.count(journal_fsyncs=1)
+                    self._durable_lsn = max(self._durable_lsn, target)
+                finally:
+                    self._syncing = False
+                    self._cond.notify_all()
+
+    def size(self) -> int:
+        with self._cond:
+            self._file.flush()
+            return os.fstat(self._file.fileno()).st_size
+
+    def replay(self, start: int = 0) -> Iterator[dict]:
+        """Целые записи журнала по порядку, начиная со смещения start.
+
+        Оборванный хвост отбрасывается.
+        """
+        self._file.flush()
+        valid_size = start
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                checksum, _, payload = raw.rstrip(b"\n").partition(b" ")
+                try:
+                    if int(checksum, 16) != zlib.crc32(payload):
+                        break
+                    entry = json.loads(payload)
+                except ValueError:
+                    break
+                valid_size += len(raw)
+                yield entry
+        if valid_size < os.path.getsize(self.path):
+            self._file.truncate(valid_size)
+
+    def reset(self) -> None:
+        # Вызывается после контрольной точки, когда все изменения уже в файлах данных
+        with self._cond:
+            self._file.flush()
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._cond:
+            if not self._file.closed:
+                self._file.flush()
+                self._file.close()
@@ -0,0 +1,90 @@
+import bisect
+import json
+import os
+
+from storage import ENCODING
+
+
+class SalesLeaderboard:
+    """Счётчики продаж по моделям и упорядоченный по ним рейтинг.
+
+    Рейтинг — отсортированный список (-продажи, название модели, id модели), поэтому
+    первые k мест читаются за O(k), а изменение счётчика — это два бинарных поиска.
+    Продажи считаются по id модели, даже если самой модели ещё нет: в рейтинг модель
+    попадает, когда становится известно её название (set_name). Счётчики сохраняются
+    в файл, чтобы при запуске не пересчитывать продажи.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._counts: dict[int, int] = {}
+        self._names: dict[int, str] = {}
+        self._order: list[tuple[int, str, int]] = []
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding=ENCODING) as f:
+            data = json.load(f)
+        self._counts, self._names, self._order = {}, {}, []
+        for model_id, (name, count) in data.items():
+            if name is not None:
+                self._names[int(model_id)] = name
+            if count > 0:
+                self._counts[int(model_id)] = count
+        self._order = sorted((-count, self._names[model_id], model_id)
+                             for model_id, count in self._counts.items() if model_id in self._names)
+        return True
+
+    def save(self) -> None:
+        data = {str(model_id): [self._names.get(model_id), self._counts.get(model_id, 0)]
+                for model_id in self._counts.keys() | self._names.keys()}
+        with open(self.path + ".tmp", "w", encoding=ENCODING) as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self) -> None:
+        self._counts, self._names, self._order = {}, {}, []
+
+    def knows(self, model_id: int) -> bool:
+        return model_id in self._names
+
+    def count(self, model_id: int) -> int:
+        return self._counts.get(model_id, 0)
+
+    def increment(self, model_id: int, delta: int = 1, name: str | None = None) -> None:
+        # Вызывается после записи операции в журнал, поэтому не бросает исключений:
+        # счётчик не опускается ниже нуля
+        old = self._counts.get(model_id, 0)
+        new = max(old + delta, 0)
+        self._unrank(model_id)
+        if name is not None:
+            self._names[model_id] = name
+        if new > 0:
+            self._counts[model_id] = new
+        else:
+            self._counts.pop(model_id, None)
+        self._rank(model_id)
+
+    def set_name(self, model_id: int, name: str) -> None:
+        self._unrank(model_id)
+        self._names[model_id] = name
+        self._rank(model_id)
+
+    def _unrank(self, model_id: int) -> None:
+        count, name = self._counts.get(model_id, 0), self._names.get(model_id)
+        if count > 0 and name is not None:
+            del self._order[bisect.bisect_left(self._order, (-count, name, model_id))]
+
+    def _rank(self, model_id: int) -> None:
+        count, name = self._counts.get(model_id, 0), self._names.get(model_id)
+        if count > 0 and name is not None:
+            bisect.insort(self._order, (-count, name, model_id))
+
+    def top(self, k: int) -> list[tuple[int, str, int]]:
+        """Первые k моделей с известным названием: (id модели, название, число продаж)."""
+        if k < 0:
+            raise ValueError(f"k must be non-negative, got {k}")
+        return [(model_id, name, -neg_count) for neg_count, name, model_id in self._order[:k]]
@@ -0,0 +1,110 @@
+import fcntl  # только POSIX, как и os.pread/os.pwrite в storage: Windows не поддерживается
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+_STATE_FORMAT = b"%020d %020d\n"
+_STATE_SIZE = len(_STATE_FORMAT % (0, 0))
+
+
+class ServiceLock:
+    """Блокировка читателей и писателей для одного каталога данных.
+
+    Внутри процесса читатели работают параллельно, писатель — один и с приоритетом
+    перед новыми читателями; блокировка писателя повторно входима. Между процессами
+    те же права дают рекомендательные блокировки fcntl.flock на файле lock. Если
+    блокировку писателя уже ждёт другой поток процесса, она передаётся ему без
+    снятия flock: другие процессы получают каталог, только когда очередь писателей
+    процесса закончилась.
+
+    В файле lock также хранится состояние каталога: номер эпохи (меняется, когда
+    индексы и файлы данных переписаны целиком) и размер журнала на момент его очистки.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer: int | None = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._exclusive = False  # flock писателя держится, в том числе между писателями очереди
+
+    def is_writer(self) -> bool:
+        return self._writer == threading.get_ident()
+
+    def has_waiting_writers(self) -> bool:
+        return self._writers_waiting > 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        if self.is_writer():
+            # Писатель может читать внутри своей операции
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            if self._readers == 0:
+                fcntl.flock(self._fd, fcntl.LOCK_SH)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[bool]:
+        """Захватывает блокировку писателя; значение — первый ли это вход в потоке."""
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                except BaseException:
+                    if self._writer is None and self._writers_waiting == 1 and self._exclusive:
+                        # Очередь писателей закончилась на прерванном ожидании
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+                        self._exclusive = False
+                        self._cond.notify_all()
+                    raise
+                finally:
+                    self._writers_waiting -= 1
+                if not self._exclusive:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                    self._exclusive = True
+                self._writer = me
+            self._write_depth += 1
+        try:
+            yield self._write_depth == 1
+        finally:
+            with self._cond:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._writer = None
+                    if not self._writers_waiting:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+                        self._exclusive = False
+                    self._cond.notify_all()
+
+    def read_state(self) -> tuple[int, int]:
+        data = os.pread(self._fd, _STATE_SIZE, 0)
+        if len(data) < _STATE_SIZE:
+            return 0, 0
+        epoch, truncated_at = data.split()
+        return int(epoch), int(truncated_at)
+
+    def write_state(self, epoch: int, truncated_at: int) -> None:
+        # Вызывается только под блокировкой писателя
+        os.pwrite(self._fd, _STATE_FORMAT % (epoch, truncated_at), 0)
+
+    def close(self) -> None:
+        os.close(self._fd)
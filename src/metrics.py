@@ -0,0 +1,114 @@
+import functools
+import threading
+import time
+from typing import Callable, TypeVar
+
+F = TypeVar("F", bound=Callable)
+
+# Верхние границы корзин гистограммы задержек в микросекундах: 1, 2, 4, ... ~67 с
+LATENCY_BUCKETS_US = tuple(2 ** i for i in range(27))
+
+ProfileHook = Callable[[str, float], None]  # (операция, секунды)
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с корзинами по степеням двойки."""
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(LATENCY_BUCKETS_US) + 1)  # последняя — всё, что дольше
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        micros = int(seconds * 1_000_000)
+        # Номер корзины — число бит в задержке, без поиска по границам
+        self.buckets[min(micros.bit_length(), len(LATENCY_BUCKETS_US))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """Оценка сверху: граница корзины, в которую попадает q-я доля вызовов, в мс."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return LATENCY_BUCKETS_US[i] / 1000 if i < len(LATENCY_BUCKETS_US) else self.max * 1000
+        return self.max * 1000
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "p50_ms": self.percentile(0.50),
+            "p99_ms": self.percentile(0.99),
+            "buckets_us": {
+                (f"<={LATENCY_BUCKETS_US[i]}" if i < len(LATENCY_BUCKETS_US) else "more"): n
+                for i, n in enumerate(self.buckets) if n
+            },
+        }
+
+
+class Metrics:
+    """Счётчики вызовов и ввода-вывода одного сервиса.
+
+    Компоненты хранилища держат ссылку на Metrics или None; при None счёт не ведётся
+    вовсе, поэтому выключенные метрики стоят одной проверки атрибута.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.operations: dict[str, LatencyHistogram] = {}
+        self.counters: dict[str, int] = {}
+
+    def observe(self, operation: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.operations.get(operation)
+            if histogram is None:
+                histogram = self.operations[operation] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def count(self, **amounts: int) -> None:
+        with self._lock:
+            for name, amount in amounts.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self.operations = {}
+            self.counters = {}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "operations": {name: histogram.as_dict() for name, histogram in sorted(self.operations.items())},
+                "io": dict(sorted(self.counters.items())),
+            }
+
+
+def instrumented(method: F) -> F:
+    """Замеряет метод сервиса, если включены метрики или задан profile_hook."""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics, hook = self._metrics, self.profile_hook
+        if metrics is None and hook is None:
+            return method(self, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if metrics is not None:
+                metrics.observe(name, elapsed)
+            if hook is not None:
+                hook(name, elapsed)
+
+    return wrapper
@@ -0,0 +1,162 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from decimal import Decimal
+
+from models import Car, CarStatus, Model, Sale
+
+MONEY_SCALE = 100  # аналитика и индекс цен считают деньги в сотых
+
+
+def to_scaled(value: Decimal) -> tuple[int, int]:
+    # Точная сумма как целое и показатель степени: value == units * 10 ** exp, а запись
+    # числа ("2000", "2000.00", "1.005") восстанавливается из них без изменений
+    exp = value.as_tuple().exponent
+    return int(value.scaleb(-exp)), exp
+
+
+def from_scaled(units: int, exp: int) -> Decimal:
+    return Decimal(units).scaleb(exp)
+
+
+def scaled_cents(units: int, exp: int) -> int:
+    # Сумма в целых сотых, доли сотой отбрасываются вниз
+    shift = exp + 2
+    return units * 10 ** shift if shift >= 0 else units // 10 ** -shift
+
+
+class Record(ABC):
+    """Запись хранилища: объект со __slots__ вместо модели pydantic.
+
+    Записи читаются из своих же файлов, поэтому при разборе строки проверка типов не
+    повторяется, а модели pydantic строятся через model_construct только на границе
+    публичного API. Порядок полей совпадает с моделью, формат файлов прежний.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    @abstractmethod
+    def parse(cls, fields: list[str]) -> "Record":
+        ...
+
+    @abstractmethod
+    def fields(self) -> list[str]:
+        ...
+
+    @abstractmethod
+    def index(self) -> str:
+        ...
+
+    def __eq__(self, other: object) -> bool:
+        return type(other) is type(self) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+
+class ModelRecord(Record):
+    __slots__ = ("id", "name", "brand")
+
+    def __init__(self, id: int, name: str, brand: str) -> None:
+        self.id = id
+        self.name = name
+        self.brand = brand
+
+    @classmethod
+    def from_model(cls, model: Model) -> "ModelRecord":
+        return cls(model.id, model.name, model.brand)
+
+    def to_model(self) -> Model:
+        return Model.model_construct(id=self.id, name=self.name, brand=self.brand)
+
+    @classmethod
+    def parse(cls, fields: list[str]) -> "ModelRecord":
+        model_id, name, brand = fields
+        return cls(int(model_id), name, brand)
+
+    def fields(self) -> list[str]:
+        return [str(self.id), self.name, self.brand]
+
+    def index(self) -> str:
+        return str(self.id)
+
+
+class CarRecord(Record):
+    __slots__ = ("vin", "model", "price_units", "price_exp", "date_start", "status")
+
+    def __init__(
+        self, vin: str, model: int, price_units: int, price_exp: int, date_start: datetime, status: CarStatus
+    ) -> None:
+        self.vin = vin
+        self.model = model
+        # Цена хранится точно: price_units * 10 ** price_exp (см. to_scaled)
+        self.price_units = price_units
+        self.price_exp = price_exp
+        self.date_start = date_start
+        self.status = status
+
+    @property
+    def price(self) -> Decimal:
+        return from_scaled(self.price_units, self.price_exp)
+
+    @property
+    def price_cents(self) -> int:
+        return scaled_cents(self.price_units, self.price_exp)
+
+    @classmethod
+    def from_model(cls, car: Car) -> "CarRecord":
+        return cls(car.vin, car.model, *to_scaled(car.price), car.date_start, car.status)
+
+    def to_model(self) -> Car:
+        return Car.model_construct(
+            vin=self.vin, model=self.model, price=self.price, date_start=self.date_start, status=self.status)
+
+    @classmethod
+    def parse(cls, fields: list[str]) -> "CarRecord":
+        vin, model, price, date_start, status = fields
+        return cls(vin, int(model), *to_scaled(Decimal(price)), datetime.fromisoformat(date_start), CarStatus(status))
+
+    def fields(self) -> list[str]:
+        return [self.vin, str(self.model), str(self.price), self.date_start.isoformat(), self.status.value]
+
+    def index(self) -> str:
+        return self.vin
+
+
+class SaleRecord(Record):
+    __slots__ = ("sales_number", "car_vin", "sales_date", "cost_units", "cost_exp")
+
+    def __init__(self, sales_number: str, car_vin: str, sales_date: datetime, cost_units: int, cost_exp: int) -> None:
+        self.sales_number = sales_number
+        self.car_vin = car_vin
+        self.sales_date = sales_date
+        self.cost_units = cost_units
+        self.cost_exp = cost_exp
+
+    @property
+    def cost(self) -> Decimal:
+        return from_scaled(self.cost_units, self.cost_exp)
+
+    @property
+    def cost_cents(self) -> int:
+        return scaled_cents(self.cost_units, self.cost_exp)
+
+    @classmethod
+    def from_model(cls, sale: Sale) -> "SaleRecord":
+        return cls(sale.sales_number, sale.car_vin, sale.sales_date, *to_scaled(sale.cost))
+
+    def to_model(self) -> Sale:
+        return Sale.model_construct(
+            sales_number=self.sales_number, car_vin=self.car_vin, sales_date=self.sales_date, cost=self.cost)
+
+    @classmethod
+    def parse(cls, fields: list[str]) -> "SaleRecord":
+        sales_number, car_vin, sales_date, cost = fields
+        return cls(sales_number, car_vin, datetime.fromisoformat(sales_date), *to_scaled(Decimal(cost)))
+
+    def fields(self) -> list[str]:
+        return [self.sales_number, self.car_vin, self.sales_date.isoformat(), str(self.cost)]
+
+    def index(self) -> str:
+        return self.car_vin
@@ -0,0 +1,126 @@
+import os
+import threading
+import zlib
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, Generic, Iterator, TypeVar
+
+from records import CarRecord, Record, SaleRecord
+from storage import Table, scan_file
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+T = TypeVar("T", bound=Record)
+R = TypeVar("R")
+
+PARALLEL_SCAN_MIN_ROWS = 200_000  # меньше этого полный проход по шардам идёт в текущем процессе
+
+
+def shard_of(key: str, shards: int) -> int:
+    # crc32, а не hash(): номер шарда одинаков во всех процессах и запусках
+    return zlib.crc32(key.encode()) % shards if shards > 1 else 0
+
+
+def existing_shards(root_dir: str, name: str) -> int | None:
+    """Число шардов таблицы по файлам в каталоге, None — если файлов ещё нет."""
+    if os.path.exists(os.path.join(root_dir, f"{name}.txt")):
+        return 1
+    shards = 0
+    while os.path.exists(os.path.join(root_dir, f"{name}_{shards}.txt")):
+        shards += 1
+    return shards or None
+
+
+class ShardedTable(Generic[T]):
+    """Записи одной сущности, разбитые на shards файлов по хешу ключа.
+
+    При одном шарде это обычный файл name.txt, иначе name_0.txt, name_1.txt и т.д.
+    Индексы хранят номер записи row = номер строки * shards + шард (см. Table.row),
+    поэтому по номеру из индекса сразу понятно, какой файл читать.
+    """
+
+    def __init__(self, root_dir: str, name: str, record_cls: type[T], shards: int = 1) -> None:
+        self.name = name
+        self.record_cls = record_cls
+        self.shards = shards
+        self.tables: list[Table[T]] = [
+            Table(root_dir, name if shards == 1 else f"{name}_{shard}", record_cls, shard, shards)
+            for shard in range(shards)
+        ]
+
+    def __iter__(self) -> Iterator[Table[T]]:
+        return iter(self.tables)
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self.tables)
+
+    @property
+    def dead(self) -> int:
+        return sum(table.dead for table in self.tables)
+
+    def for_key(self, key: str) -> Table[T]:
+        return self.tables[shard_of(key, self.shards)]
+
+    def locate(self, row: int) -> tuple[Table[T], int]:
+        shard, line_no = row % self.shards, row // self.shards
+        return self.tables[shard], line_no
+
+    def get(self, row: int) -> T | None:
+        table, line_no = self.locate(row)
+        return table.get(line_no)
+
+    def scan(self) -> Iterator[tuple[int, T]]:
+        for table in self.tables:
+            for line_no, record in table.scan():
+                yield table.row(line_no), record
+
+
+def shard_sales_by_model(cars_path: str, sales_path: str) -> Counter:
+    """Число продаж по id модели в одном шарде.
+
+    Продажи лежат в шарде своей машины, поэтому соединение с машинами не выходит за шард.
+    """
+    car_models = {car.vin: car.model for _, car in scan_file(cars_path, CarRecord)}
+    counts: Counter = Counter()
+    for _, sale in scan_file(sales_path, SaleRecord):
+        model = car_models.get(sale.car_vin)
+        if model is not None:
+            counts[model] += 1
+    return counts
+
+
+class ShardPool:
+    """Пул процессов для полных проходов по шардам.
+
+    Функция прохода вызывается для каждого шарда и сама читает его файлы, поэтому она
+    должна быть объявлена на уровне модуля, а изменения — уже записаны в файлы. Пул
+    запускается при первом проходе по достаточно большим данным и живёт до close().
+    Процессы создаются через forkserver и не наследуют блокировки и дескрипторы сервиса.
+    """
+
+    def __init__(self, workers: int | None = None, min_rows: int | None = None) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.min_rows = PARALLEL_SCAN_MIN_ROWS if min_rows is None else min_rows
+        self._executor: "ProcessPoolExecutor | None" = None
+        self._lock = threading.Lock()
+
+    def map(self, fn: Callable[..., R], args: list[tuple], rows: int) -> list[R]:
+        if len(args) < 2 or rows < self.min_rows:
+            return [fn(*arg) for arg in args]
+        with self._lock:
+            if self._executor is None:
+                # multiprocessing нужен только большим проходам, поэтому импорт здесь
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver") if "forkserver" in methods else None
+                self._executor = ProcessPoolExecutor(min(self.workers, len(args)), mp_context=context)
+            executor = self._executor
+        return list(executor.map(fn, *zip(*args)))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
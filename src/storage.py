@@ -0,0 +1,823 @@
+import bisect
+import glob
+import heapq
+import json
+import mmap
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Generic, Iterable, Iterator, NamedTuple, TypeVar
+
+from metrics import Metrics
+from records import Record
+
+LINE_LEN = 500  # ширина записи в байтах без символа перевода строки
+SEPARATOR = ";"
+ENCODING = "utf-8"
+
+T = TypeVar("T", bound=Record)
+
+
+def dump_record(record: Record) -> str:
+    # Поля пишутся в порядке объявления в модели, через разделитель
+    values = record.fields()
+    for text in values:
+        if SEPARATOR in text or "\n" in text:
+            raise ValueError(f"Value {text!r} contains a reserved character")
+    return SEPARATOR.join(values)
+
+
+def load_record(record_cls: type[T], line: str) -> T:
+    return record_cls.parse(line.split(SEPARATOR))
+
+
+class RecordFile:
+    """Файл записей фиксированной ширины.
+
+    Запись с номером n начинается со смещения n * (LINE_LEN + 1), поэтому чтение
+    одной записи — это один pread известной длины. Чтение и запись по смещению не
+    двигают общую позицию файла, так что читать могут несколько потоков сразу.
+
+    Изменения сначала подготавливаются в памяти (stage) с номером записи журнала и
+    попадают в файл только через apply(), когда журнал уже сброшен на диск.
+    """
+
+    def __init__(self, path: str, line_len: int = LINE_LEN) -> None:
+        self.path = path
+        self.line_len = line_len
+        self.record_size = line_len + 1
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file_count = 0
+        self.count = 0
+        self._staged: dict[int, tuple[int, str]] = {}  # номер строки -> (lsn, строка)
+        self.metrics: Metrics | None = None
+        self.refresh()
+
+    def refresh(self) -> None:
+        # Файл мог дописать другой процесс
+        self._file_count = max(self._file_count, os.fstat(self._fd).st_size // self.record_size)
+        self.count = max(self.count, self._file_count)
+
+    def _encode(self, line: str) -> bytes:
+        data = line.encode(ENCODING)
+        if len(data) > self.line_len or b"\n" in data:
+            raise ValueError(f"Record does not fit into {self.line_len} bytes: {line!r}")
+        return data.ljust(self.line_len) + b"\n"
+
+    def read(self, line_no: int) -> str:
+        if not 0 <= line_no < self.count:
+            raise IndexError(f"Line {line_no} is out of range in {self.path}")
+        staged = self._staged.get(line_no)
+        if staged is not None:
+            return staged[1]
+        if self.metrics is None:
+            return os.pread(self._fd, self.line_len, line_no * self.record_size).rstrip(b" ").decode(ENCODING)
+        started = time.perf_counter_ns()
+        data = os.pread(self._fd, self.line_len, line_no * self.record_size)
+        self.metrics.count(read_calls=1, bytes_read=len(data), read_ns=time.perf_counter_ns() - started)
+        return data.rstrip(b" ").decode(ENCODING)
+
+    def check(self, line: str) -> None:
+        # Проверка, что строка поместится в запись, без записи; ASCII-строку не нужно кодировать
+        if not (line.isascii() and len(line) <= self.line_len) or "\n" in line:
+            self._encode(line)
+
+    def stage(self, line_no: int, line: str, lsn: int) -> None:
+        # Ширина строки уже проверена check() до записи операции в журнал
+        if not 0 <= line_no <= self.count:
+            raise IndexError(f"Line {line_no} is out of range in {self.path}")
+        self._staged[line_no] = (lsn, line)
+        self.count = max(self.count, line_no + 1)
+
+    def apply(self, upto_lsn: int) -> None:
+        """Переносит в файл подготовленные изменения с lsn не больше upto_lsn."""
+        ready = sorted(line_no for line_no, (lsn, _) in self._staged.items() if lsn <= upto_lsn)
+        # Подряд идущие строки пишутся одним вызовом pwrite
+        run: list[bytes] = []
+        run_start = 0
+        for line_no in ready:
+            if run and line_no != run_start + len(run):
+                self._write_run(run_start, run)
+                run = []
+            if not run:
+                run_start = line_no
+            run.append(self._encode(self._staged.pop(line_no)[1]))
+        if run:
+            self._write_run(run_start, run)
+
+    def _write_run(self, first: int, run: list[bytes]) -> None:
+        written = os.pwrite(self._fd, b"".join(run), first * self.record_size)
+        self._file_count = max(self._file_count, first + len(run))
+        if self.metrics is not None:
+            self.metrics.count(write_calls=1, bytes_written=written)
+
+    def put(self, line_no: int, line: str) -> None:
+        # Прямая запись в файл, используется при восстановлении по журналу
+        if not 0 <= line_no <= self._file_count:
+            raise IndexError(f"Line {line_no} is out of range in {self.path}")
+        self._write_run(line_no, [self._encode(line)])
+        self.count = max(self.count, self._file_count)
+
+    def scan(self, count: int | None = None) -> Iterator[tuple[int, str]]:
+        # count — сколько первых строк читать (по умолчанию все)
+        count = self.count if count is None else count
+        with open(self.path, "rb") as f:
+            for line_no in range(count):
+                data = f.read(self.record_size) if line_no < self._file_count else b""
+                staged = self._staged.get(line_no)
+                if staged is not None:
+                    yield line_no, staged[1]
+                else:
+                    # Отступ срезается до декодирования: по байтам это в несколько раз быстрее
+                    yield line_no, data[: self.line_len].rstrip(b" ").decode(ENCODING)
+            if self.metrics is not None:
+                read = min(count, self._file_count) * self.record_size
+                self.metrics.count(scanned_records=count, bytes_read=read)
+
+    def flush(self, sync: bool = False) -> None:
+        # Записи уже переданы ОС через pwrite, остаётся только fsync
+        if sync:
+            os.fsync(self._fd)
+            if self.metrics is not None:
+                self.metrics.count(fsyncs=1)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+LIVE = "+"
+DELETED = "-"  # надгробие: запись удалена, но остаётся на месте до уплотнения файла
+
+
+def scan_file(path: str, record_cls: type[T], line_len: int = LINE_LEN) -> Iterator[tuple[int, T]]:
+    """Живые записи файла таблицы без открытия Table — для процессов, которые только читают."""
+    record_size = line_len + 1
+    live = LIVE.encode(ENCODING)
+    with open(path, "rb") as f:
+        line_no = 0
+        while len(data := f.read(record_size)) == record_size:
+            if data[:1] == live:
+                yield line_no, load_record(record_cls, data[1:line_len].rstrip(b" ").decode(ENCODING))
+            line_no += 1
+
+
+class Table(Generic[T]):
+    """Записи одной сущности (models.txt, cars.txt, sales.txt) в корневом каталоге.
+
+    Первый символ строки — флаг записи. Удаление меняет только флаг, номера
+    остальных строк не сдвигаются; место освобождает уплотнение (compaction).
+    Таблица может быть шардом shard из shards (см. sharding.ShardedTable).
+    """
+
+    def __init__(self, root_dir: str, name: str, record_cls: type[T], shard: int = 0, shards: int = 1) -> None:
+        self.name = name
+        self.record_cls = record_cls
+        self.shard = shard
+        self.shards = shards
+        self.path = os.path.join(root_dir, f"{name}.txt")
+        self.records = RecordFile(self.path)
+        self._metrics: Metrics | None = None
+        self.dead = 0  # число удалённых записей в файле
+        # Недописанные копии от прерванных уплотнений не нужны. Открытие идёт под блокировкой
+        # писателя, а копия строится под блокировкой читателей, поэтому идущую копию это не
+        # задевает; копию, удалённую между копированием и подменой, уплотнение строит заново
+        for path in glob.glob(glob.escape(self.path) + "*.compact"):
+            os.remove(path)
+
+    def __len__(self) -> int:
+        return self.records.count
+
+    @property
+    def compact_path(self) -> str:
+        # Своя копия у каждого процесса: два процесса могут уплотнять таблицу одновременно
+        return f"{self.path}.{os.getpid()}.compact"
+
+    @property
+    def metrics(self) -> Metrics | None:
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics: Metrics | None) -> None:
+        self._metrics = metrics
+        self.records.metrics = metrics
+
+    @staticmethod
+    def encode(record: Record, deleted: bool = False) -> str:
+        return (DELETED if deleted else LIVE) + dump_record(record)
+
+    def decode(self, line: str) -> T | None:
+        if not line or line[0] != LIVE:
+            return None
+        if self._metrics is None:
+            return load_record(self.record_cls, line[1:])
+        started = time.perf_counter_ns()
+        record = load_record(self.record_cls, line[1:])
+        self._metrics.count(records_decoded=1, decode_ns=time.perf_counter_ns() - started)
+        return record
+
+    def get(self, line_no: int) -> T | None:
+        return self.decode(self.records.read(line_no))
+
+    def row(self, line_no: int) -> int:
+        # Номер записи среди всех шардов, его хранят индексы; при одном шарде это номер строки
+        return line_no * self.shards + self.shard
+
+    def scan(self) -> Iterator[tuple[int, T]]:
+        for line_no, line in self.records.scan():
+            record = self.decode(line)
+            if record is not None:
+                yield line_no, record
+
+    def copy_live(self, path: str, count: int) -> Iterator[tuple[int, int, T]]:
+        """Пишет в path живые записи из первых count строк подряд и выдаёт их с прежними и новыми номерами строк."""
+        with open(path, "wb") as f:
+            new_line = 0
+            for line_no, line in self.records.scan(count):
+                record = self.decode(line)
+                if record is not None:
+                    f.write(self.records._encode(line))
+                    yield line_no, new_line, record
+                    new_line += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+    def swap(self, path: str) -> None:
+        # Подменяет файл уплотнённой копией, номера строк после этого другие
+        self.records.close()
+        os.replace(path, self.path)
+        self.records = RecordFile(self.path)
+        self.records.metrics = self._metrics
+        self.dead = 0
+
+    def reopen(self) -> None:
+        # Файл мог подменить уплотнением другой процесс
+        self.records.close()
+        self.records = RecordFile(self.path)
+        self.records.metrics = self._metrics
+
+    def flush(self, sync: bool = False) -> None:
+        self.records.flush(sync)
+
+    def close(self) -> None:
+        self.records.close()
+
+
+class BatchItem(NamedTuple):
+    table: Table
+    line_no: int
+    old: str  # прежняя строка, пустая для новой записи
+    new: str
+    record: Record | None  # записанная запись, если она известна без разбора строки
+    old_record: Record | None = None  # прежняя запись, если она уже прочитана
+
+
+class WriteBatch:
+    """Изменения файлов данных, составляющие одну операцию сервиса.
+
+    Номера новых строк выделяются сразу, а сами записи попадают в таблицы только
+    после записи операции в журнал. Вместе с новой строкой хранится прежняя: по ней
+    индексы (в том числе в других процессах) убирают старые ключи.
+    """
+
+    def __init__(self) -> None:
+        self.items: list[BatchItem] = []
+        self._next_line: dict[str, int] = {}
+
+    def append(self, table: Table, obj: Record) -> int:
+        line_no = self._next_line.get(table.name, len(table))
+        self._next_line[table.name] = line_no + 1
+        self.items.append(BatchItem(table, line_no, "", table.encode(obj), obj))
+        return line_no
+
+    def update(self, table: Table, line_no: int, obj: Record, old: tuple[str, Record] | None = None) -> None:
+        # old — прежние строка и запись, если вызывающий код их уже прочитал (и не менял)
+        old_line, old_record = old if old is not None else (table.records.read(line_no), None)
+        self.items.append(BatchItem(table, line_no, old_line, table.encode(obj), obj, old_record))
+
+    def delete(self, table: Table, line_no: int, obj: Record) -> None:
+        # Запись остаётся в файле с флагом удаления — одна запись на месте
+        old = table.records.read(line_no)
+        self.items.append(BatchItem(table, line_no, old, table.encode(obj, deleted=True), None))
+
+
+KEY_LEN = 64  # ширина ключа в индексном файле
+LINE_NO_LEN = 10
+ENTRY_LEN = KEY_LEN + 1 + LINE_NO_LEN  # "ключ;номер_строки" без перевода строки
+MERGE_THRESHOLD = 50_000  # сколько изменений копится в памяти до перезаписи индексного файла
+# Пока изменений не больше 1/BYTE_MERGE_RATIO записей файла, flush() ищет место каждого из них
+# бинарным поиском (_splice), иначе проходит файл целиком (_merge)
+BYTE_MERGE_RATIO = 16
+INSORT_MAX = 16  # пачка add_many до этого размера вставляется по одной записи, большая — слиянием
+# Словарь HashIndex строится после len(index) // LOAD_AFTER_RATIO запросов: бинарный поиск
+# по файлу примерно в LOAD_AFTER_RATIO раз дороже, чем чтение одной записи при загрузке
+LOAD_AFTER_RATIO = 16
+
+
+def _encode_key(key: str) -> bytes:
+    data = key.encode(ENCODING)
+    if len(data) > KEY_LEN or b"\n" in data:
+        raise ValueError(f"Index key does not fit into {KEY_LEN} bytes: {key!r}")
+    return data.ljust(KEY_LEN)
+
+
+_LINE_NO_FORMAT = b"%s%%0%dd\n" % (SEPARATOR.encode(), LINE_NO_LEN)
+
+
+def _encode_entry(key: str, line_no: int) -> bytes:
+    # Ключи проверены при добавлении, здесь они только дополняются до ширины записи
+    return key.encode(ENCODING).ljust(KEY_LEN) + _LINE_NO_FORMAT % line_no
+
+
+def check_index_key(key: str) -> None:
+    _encode_key(key)
+
+
+def check_index_keys(keys: Iterable[str]) -> None:
+    # Короткие ASCII-ключи без перевода строки заведомо помещаются: пачка проверяется
+    # целиком, по одному кодируются ключи, только если в пачке есть другие
+    keys = list(keys)
+    joined = "".join(keys)
+    if joined.isascii() and "\n" not in joined and max(map(len, keys), default=0) <= KEY_LEN:
+        return
+    for key in keys:
+        _encode_key(key)
+
+
+# Строковые ключи, порядок которых совпадает с порядком значений
+
+INT_KEY_DIGITS = 19
+INT_KEY_LIMIT = 10 ** INT_KEY_DIGITS
+
+
+def int_key(value: int) -> str:
+    # Неотрицательные — "0" и цифры с ведущими нулями; отрицательные — "-" (он
+    # меньше "0") и дополнение до 10**19, чтобы больший модуль шёл раньше
+    if not -INT_KEY_LIMIT < value < INT_KEY_LIMIT:
+        raise ValueError(f"Value {value} does not fit into an index key")
+    if value < 0:
+        return f"-{INT_KEY_LIMIT + value:0{INT_KEY_DIGITS}d}"
+    return f"0{value:0{INT_KEY_DIGITS}d}"
+
+
+def money_key(units: int, exp: int) -> str:
+    # Сумма units * 10 ** exp: целые сотые (с округлением вниз) как int_key, за ними цифры
+    # остатка без конечных нулей. У сумм до сотых ключ тот же, что int_key от числа сотых
+    shift = exp + 2
+    if shift >= 0:
+        return int_key(units * 10 ** shift)
+    cents, rest = divmod(units, 10 ** -shift)
+    return int_key(cents) + f"{rest:0{-shift}d}".rstrip("0")
+
+
+def datetime_key(value: datetime) -> str:
+    # Наивное время считается UTC, как и в аналитике; ширина isoformat постоянна
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="microseconds")
+
+
+class SortedIndex:
+    """Отсортированный индексный файл "ключ -> номер строки".
+
+    Записи файла фиксированной ширины и упорядочены по (ключ, номер строки), поиск —
+    бинарный по отображённому в память файлу. Свежие изменения копятся в памяти и
+    сливаются с файлом при flush() или после MERGE_THRESHOLD изменений. Большие пачки
+    add_many не сортируются сразу, а сливаются с остальными изменениями при первом
+    чтении: пакетная загрузка сортирует новые записи один раз, а не на каждой пачке.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entry_size = ENTRY_LEN + 1
+        self._mm: mmap.mmap | None = None
+        self._size = 0
+        self._added: list[tuple[str, int]] = []  # отсортированные новые записи
+        self._pending: list[tuple[str, int]] = []  # новые записи больших пачек, ещё не в _added
+        self._removed: set[tuple[str, int]] = set()  # удалённые записи из файла
+        self._settle_lock = threading.Lock()
+        self.metrics: Metrics | None = None
+        self.generation = 0  # меняется при каждом открытии файла заново
+        self._open_base()
+
+    def _open_base(self) -> None:
+        # Старое отображение не закрываем явно: его могут ещё читать открытые итераторы
+        self._mm = None
+        self._size = 0
+        self.generation += 1
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._size = len(self._mm) // self.entry_size
+
+    def _entry_at(self, mm: mmap.mmap, i: int) -> tuple[str, int]:
+        offset = i * self.entry_size
+        entry = mm[offset: offset + ENTRY_LEN]
+        return entry[:KEY_LEN].rstrip(b" ").decode(ENCODING), int(entry[KEY_LEN + 1:])
+
+    def _bisect(self, mm: mmap.mmap | None, size: int, key: bytes, right: bool = False) -> int:
+        # key — ключ, дополненный до KEY_LEN, или целая запись "ключ;номер_строки"
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * self.entry_size
+            probe = mm[offset: offset + len(key)]
+            if probe < key or (right and probe == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __len__(self) -> int:
+        return self._size - len(self._removed) + len(self._added) + len(self._pending)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._added or self._pending or self._removed)
+
+    def _settled(self) -> list[tuple[str, int]]:
+        # Отложенные пачки сливаются с _added; читатели работают параллельно, поэтому
+        # слияние идёт под своей блокировкой
+        if self._pending:
+            with self._settle_lock:
+                if self._pending:
+                    added = self._added + self._pending
+                    added.sort()
+                    self._added, self._pending = added, []
+        return self._added
+
+    def lookup(self, key: str) -> list[int]:
+        return [line_no for _, line_no in self.items(key, key)]
+
+    def get(self, key: str) -> int | None:
+        return next((line_no for _, line_no in self.items(key, key)), None)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def add(self, key: str, line_no: int) -> None:
+        _encode_key(key)
+        if (key, line_no) in self._removed:
+            self._removed.discard((key, line_no))
+        else:
+            bisect.insort(self._added, (key, line_no))
+        self._maybe_merge()
+
+    def add_many(self, entries: Iterable[tuple[str, int]]) -> None:
+        # Пачка сливается с накопленными изменениями за один проход; файл
+        # перезаписывается при следующем flush(), а не после каждой пачки.
+        # Ключи пачки уже проверены вызывающим кодом (check_index_key)
+        new = list(entries)
+        if len(new) <= INSORT_MAX:
+            # Несколько записей (например, продажи одной машины) вставляются бинарным поиском
+            for entry in new:
+                bisect.insort(self._added, entry)
+            return
+        self._pending.extend(new)
+
+    def remove(self, key: str, line_no: int) -> None:
+        self._settled()
+        i = bisect.bisect_left(self._added, (key, line_no))
+        if i < len(self._added) and self._added[i] == (key, line_no):
+            del self._added[i]
+        else:
+            self._removed.add((key, line_no))
+        self._maybe_merge()
+
+    def remove_many(self, entries: Iterable[tuple[str, int]]) -> None:
+        # Как и add_many, не перезаписывает файл до flush()
+        self._settled()
+        for key, line_no in entries:
+            i = bisect.bisect_left(self._added, (key, line_no))
+            if i < len(self._added) and self._added[i] == (key, line_no):
+                del self._added[i]
+            else:
+                self._removed.add((key, line_no))
+
+    def items(
+        self, start: str | None = None, stop: str | None = None, after: tuple[str, int] | None = None
+    ) -> Iterator[tuple[str, int]]:
+        """Записи с ключами из отрезка [start, stop] в порядке возрастания.
+
+        С after обход начинается сразу после записи after = (ключ, номер строки), а не с
+        start: так продолжают обход с места остановки даже среди равных ключей.
+        Итератор держит ссылку на текущее отображение файла, поэтому слияние индекса
+        во время обхода его не ломает.
+        """
+        if self.metrics is not None:
+            self.metrics.count(index_probes=1)
+        mm, size, removed = self._mm, self._size, self._removed
+        if after is not None:
+            key, line_no = after
+            lo = self._bisect(mm, size, _encode_key(key) + b"%s%0*d" % (SEPARATOR.encode(), LINE_NO_LEN, line_no),
+                              right=True)
+        else:
+            lo = self._bisect(mm, size, _encode_key(start)) if start is not None else 0
+        hi = self._bisect(mm, size, _encode_key(stop), right=True) if stop is not None else size
+
+        def base() -> Iterator[tuple[str, int]]:
+            for i in range(lo, hi):
+                entry = self._entry_at(mm, i)
+                if entry not in removed:
+                    yield entry
+
+        settled = self._settled()
+        if after is not None:
+            added_lo = bisect.bisect_right(settled, after)
+        else:
+            added_lo = bisect.bisect_left(settled, (start, -1)) if start is not None else 0
+        added_hi = bisect.bisect_right(settled, (stop, float("inf"))) if stop is not None else len(settled)
+        added = settled[added_lo:added_hi]
+        return heapq.merge(base(), added) if added else base()
+
+    def base(self) -> tuple[int, Iterator[tuple[str, int]]]:
+        """Поколение файла и его записи без изменений в памяти; итератор можно читать без блокировок."""
+        mm, size = self._mm, self._size
+        return self.generation, (self._entry_at(mm, i) for i in range(size))
+
+    def changes(self) -> tuple[set[tuple[str, int]], list[tuple[str, int]]]:
+        # Изменения в памяти поверх файла: удалённые из файла и добавленные записи
+        return self._removed, self._settled()
+
+    def rebuild(self, entries: Iterable[tuple[str, int]]) -> None:
+        self._write(sorted(entries))
+
+    def _maybe_merge(self) -> None:
+        if len(self._added) + len(self._pending) + len(self._removed) >= MERGE_THRESHOLD:
+            self.flush()
+
+    def _write(self, entries: Iterable[tuple[str, int]]) -> None:
+        self._write_chunks(_encode_entry(key, line_no) for key, line_no in entries)
+
+    def _write_chunks(self, chunks: Iterable[bytes]) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.writelines(chunks)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._added = []
+        self._pending = []
+        self._removed = set()
+        self._open_base()
+
+    def flush(self) -> None:
+        # Записи файла не разбираются заново, а копируются байтами: порядок закодированных
+        # записей тот же, что у пар (ключ, номер строки)
+        changes = len(self._added) + len(self._pending) + len(self._removed)
+        if self._mm is None or not os.path.exists(self.path):
+            if self.dirty or not os.path.exists(self.path):
+                self._write(list(self.items()))
+        elif changes * BYTE_MERGE_RATIO <= self._size:
+            if changes:
+                self._splice()
+        else:
+            self._merge()
+
+    def _merge(self) -> None:
+        # Один проход по файлу: удалённые записи пропускаются, новые вливаются по порядку
+        mm, size, entry_size = self._mm, self._size, self.entry_size
+        removed = {_encode_entry(key, line_no) for key, line_no in self._removed}
+        added = [_encode_entry(key, line_no) for key, line_no in self._settled()]
+        base: Iterator[bytes] = (mm[i * entry_size: (i + 1) * entry_size] for i in range(size))
+        if removed:
+            base = (entry for entry in base if entry not in removed)
+        self._write_chunks(heapq.merge(base, added) if added else base)
+
+    def _splice(self) -> None:
+        # Места немногих изменений находятся бинарным поиском по целой записи, а участки
+        # файла между ними копируются целиком
+        mm, size, entry_size = self._mm, self._size, self.entry_size
+        changes: list[tuple[int, bytes]] = []  # (позиция в файле, новая запись или b"" для удаления)
+        for key, line_no in self._removed:
+            entry = _encode_entry(key, line_no)[:-1]
+            i = self._bisect(mm, size, entry)
+            if i < size and mm[i * entry_size: i * entry_size + ENTRY_LEN] == entry:
+                changes.append((i, b""))
+        for key, line_no in self._settled():
+            entry = _encode_entry(key, line_no)
+            changes.append((self._bisect(mm, size, entry[:-1]), entry))
+        # На одной позиции вставки идут раньше удаления записи файла, стоящей на ней
+        changes.sort(key=lambda change: (change[0], not change[1], change[1]))
+
+        def chunks() -> Iterator[bytes]:
+            done = 0
+            for i, entry in changes:
+                yield mm[done * entry_size: i * entry_size]
+                if entry:
+                    yield entry
+                    done = i
+                else:
+                    done = i + 1
+            yield mm[done * entry_size: size * entry_size]
+
+        self._write_chunks(chunks())
+
+    def reload(self) -> None:
+        # Отбрасывает изменения в памяти: файл переписал другой процесс
+        self._added = []
+        self._pending = []
+        self._removed = set()
+        self._open_base()
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+class HashIndex:
+    """Хеш-индекс в памяти поверх SortedIndex.
+
+    Точечные запросы обслуживает словарь, отсортированный файл остаётся формой
+    хранения и используется для обхода по порядку ключей. Словарь строится не при
+    открытии, а после len(index) // LOAD_AFTER_RATIO запросов: до этого запросы идут
+    бинарным поиском по отображённому файлу, так что открытие не зависит от объёма
+    данных, а чтение всего файла окупается только на часто используемом индексе.
+    Файл читается в словарь фоновым потоком, запросы тем временем идут по файлу.
+    """
+
+    def __init__(self, index: SortedIndex, unique: bool = True) -> None:
+        self.sorted = index
+        self.unique = unique
+        self._map: dict[str, int | list[int]] | None = None
+        self._probes = 0  # запросы, обслуженные без словаря
+        self._loader: threading.Thread | None = None
+        self._built: tuple[int, dict[str, int | list[int]]] | None = None  # словарь файла от загрузчика
+        self._install_lock = threading.Lock()
+        self._closing = False
+
+    def _loaded(self) -> dict[str, int | list[int]] | None:
+        # Вызывается под блокировкой сервиса (читателей или писателя), поэтому
+        # изменения индекса не идут одновременно с подключением словаря
+        if self._map is None:
+            if self._built is not None:
+                self._install()
+            elif self._loader is None:
+                self._probes += 1
+                if self._probes > len(self.sorted) // LOAD_AFTER_RATIO:
+                    self._loader = threading.Thread(
+                        target=self._load, args=self.sorted.base(), name="bibip-index-load", daemon=True)
+                    self._loader.start()
+        return self._map
+
+    def _load(self, generation: int, entries: Iterator[tuple[str, int]]) -> None:
+        # Фоновый поток: читает только файл, который не меняется (его заменяют новым)
+        loaded: dict[str, int | list[int]] = {}
+        for key, line_no in entries:
+            if self._closing:
+                return
+            self._put(loaded, key, line_no)
+        self._built = generation, loaded
+
+    def _install(self) -> None:
+        # Читатели могут прийти сюда одновременно: словарь подключает один из них
+        with self._install_lock:
+            if self._map is not None or self._built is None:
+                return
+            generation, loaded = self._built
+            self._built = None
+            self._loader = None
+            if generation != self.sorted.generation:
+                return  # файл переписан во время загрузки: следующий запрос начнёт её заново
+            removed, added = self.sorted.changes()
+            for key, line_no in removed:
+                self._remove(loaded, key, line_no)
+            for key, line_no in added:
+                self._put(loaded, key, line_no)
+            self._map = loaded
+
+    def _put(self, mapping: dict[str, int | list[int]], key: str, line_no: int) -> None:
+        if self.unique:
+            mapping[key] = line_no
+        else:
+            mapping.setdefault(key, []).append(line_no)
+
+    def _reset(self) -> None:
+        # Загрузка, которая уже идёт, закончится словарём старого поколения файла и будет отброшена
+        self._map = None
+        self._probes = 0
+
+    def __len__(self) -> int:
+        return len(self.sorted)
+
+    @property
+    def metrics(self) -> Metrics | None:
+        return self.sorted.metrics
+
+    @metrics.setter
+    def metrics(self, metrics: Metrics | None) -> None:
+        self.sorted.metrics = metrics
+
+    @property
+    def loaded(self) -> bool:
+        return self._map is not None
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    @property
+    def dirty(self) -> bool:
+        return self.sorted.dirty
+
+    def get(self, key: str) -> int | None:
+        mapping = self._loaded()
+        if mapping is None:
+            return self.sorted.get(key)
+        if self.sorted.metrics is not None:
+            self.sorted.metrics.count(index_probes=1)
+        value = mapping.get(key)
+        if value is None or self.unique:
+            return value
+        return value[0] if value else None
+
+    def lookup(self, key: str) -> list[int]:
+        mapping = self._loaded()
+        if mapping is None:
+            return self.sorted.lookup(key)
+        if self.sorted.metrics is not None:
+            self.sorted.metrics.count(index_probes=1)
+        value = mapping.get(key)
+        if value is None:
+            return []
+        return [value] if self.unique else list(value)
+
+    def add(self, key: str, line_no: int) -> None:
+        self.sorted.add(key, line_no)
+        if self._map is not None:
+            self._put(self._map, key, line_no)
+
+    def add_many(self, entries: Iterable[tuple[str, int]]) -> None:
+        entries = list(entries)
+        self.sorted.add_many(entries)
+        if self._map is not None:
+            for key, line_no in entries:
+                self._put(self._map, key, line_no)
+
+    def remove(self, key: str, line_no: int) -> None:
+        self.sorted.remove(key, line_no)
+        self._drop(key, line_no)
+
+    def remove_many(self, entries: Iterable[tuple[str, int]]) -> None:
+        entries = list(entries)
+        self.sorted.remove_many(entries)
+        for key, line_no in entries:
+            self._drop(key, line_no)
+
+    def _drop(self, key: str, line_no: int) -> None:
+        if self._map is not None:
+            self._remove(self._map, key, line_no)
+
+    def _remove(self, mapping: dict[str, int | list[int]], key: str, line_no: int) -> None:
+        if self.unique:
+            del mapping[key]
+        else:
+            mapping[key].remove(line_no)
+            if not mapping[key]:
+                del mapping[key]
+
+    def items(self, start: str | None = None, stop: str | None = None) -> Iterator[tuple[str, int]]:
+        return self.sorted.items(start, stop)
+
+    def rebuild(self, entries: Iterable[tuple[str, int]]) -> None:
+        self.sorted.rebuild(entries)
+        self._reset()
+
+    def flush(self) -> None:
+        self.sorted.flush()
+
+    def reload(self) -> None:
+        self.sorted.reload()
+        self._reset()
+
+    def close(self) -> None:
+        self._closing = True
+        if self._loader is not None:
+            self._loader.join()
+        self.sorted.close()
+
+
+META_FILE = "meta.json"
+# Версия формата файлов каталога; meta.json хранит её вместе с шириной записи и числом
+# записей в файлах, чтобы открытие проверяло каталог, не читая сами файлы
+SCHEMA_VERSION = 1
+
+
+def read_meta(root_dir: str) -> dict:
+    path = os.path.join(root_dir, META_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding=ENCODING) as f:
+        return json.load(f)
+
+
+def write_meta(root_dir: str, meta: dict) -> None:
+    # Запись через временный файл, чтобы метаданные не оказались недописанными
+    path = os.path.join(root_dir, META_FILE)
+    with open(path + ".tmp", "w", encoding=ENCODING) as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
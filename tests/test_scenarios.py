@@ -1,10 +1,24 @@
-from datetime import datetime
+import asyncio
+import csv
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
 import pytest
 
+import analytics
+import bibip_car_service
+import sharding
+import storage
+from async_service import AsyncCarService
 from bibip_car_service import CarService
+from ingest import BulkLoadError
 from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale
+from storage import LINE_LEN, SCHEMA_VERSION, read_meta, write_meta
 
 
 @pytest.fixture
@@ -207,6 +221,10 @@ class TestCarServiceScenarios:
         assert service.get_car_info("UPDGM4A77D5316538") == full_info_no_sale
         assert service.get_car_info("KNAGM4A77D5316538") is None
 
+        # Переименование в тот же VIN ничего не меняет
+        service.update_vin("UPDGM4A77D5316538", "UPDGM4A77D5316538")
+        assert service.get_car_info("UPDGM4A77D5316538") == full_info_no_sale
+
     def test_delete_sale(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
         service = CarService(tmpdir)
 
@@ -290,3 +308,715 @@ class TestCarServiceScenarios:
             ModelSaleStats(car_model_name="Pathfinder", brand="Nissan", sales_number=1),
         ]
         assert service.top_models_by_sales() == top_3_models
+
+    def test_reopen_service(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        with CarService(tmpdir) as service:
+            self._fill_initial_data(service, car_data, model_data)
+            service.sell_car(
+                Sale(
+                    sales_number="20240903#KNAGM4A77D5316538",
+                    car_vin="KNAGM4A77D5316538",
+                    sales_date=datetime(2024, 9, 3),
+                    cost=Decimal("2999.99"),
+                )
+            )
+            expected = service.get_car_info("KNAGM4A77D5316538")
+
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("KNAGM4A77D5316538") == expected
+        assert reopened.get_cars(CarStatus.available) == [
+            car for car in car_data if car.status == CarStatus.available and car.vin != "KNAGM4A77D5316538"
+        ]
+
+    def test_revert_sale_after_vin_update(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        service.sell_car(
+            Sale(
+                sales_number="20240903#KNAGM4A77D5316538",
+                car_vin="KNAGM4A77D5316538",
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+        )
+        service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+
+        car = service.get_car_info("UPDGM4A77D5316538")
+        assert car is not None
+        assert car.sales_cost == Decimal("2999.99")
+
+        service.revert_sale("20240903#KNAGM4A77D5316538")
+
+        car = service.get_car_info("UPDGM4A77D5316538")
+        assert car is not None
+        assert car.status == CarStatus.available
+        assert car.sales_date is None
+        with pytest.raises(ValueError):
+            service.revert_sale("20240903#KNAGM4A77D5316538")
+
+    def test_top_models_after_revert_and_reopen(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        for vin in ["KNAGM4A77D5316538", "JM1BL1TFXD1734246", "JM1BL1M58C1614725", "5N1CR2MN9EC641864"]:
+            service.sell_car(
+                Sale(sales_number=f"20240903#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("100"))
+            )
+        service.revert_sale("20240903#JM1BL1M58C1614725")
+
+        expected = [
+            ModelSaleStats(car_model_name="3", brand="Mazda", sales_number=1),
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=1),
+        ]
+        assert service.top_models_by_sales(k=2) == expected
+        assert service.top_models_by_sales(k=0) == []
+        with pytest.raises(ValueError):
+            service.top_models_by_sales(k=-1)
+        service.close()
+
+        assert CarService(tmpdir).top_models_by_sales(k=2) == expected
+
+    def test_top_models_counts_sales_before_model_added(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model]
+    ):
+        service = CarService(tmpdir)
+        service.add_car(car_data[0])
+        service.sell_car(
+            Sale(sales_number="S1", car_vin=car_data[0].vin, sales_date=datetime(2024, 9, 3), cost=Decimal("100"))
+        )
+        # Модели ещё нет: продажа посчитана, но в рейтинге не видна
+        assert service.top_models_by_sales() == []
+        service.close()
+
+        service = CarService(tmpdir)
+        service.add_model(model_data[0])
+        assert service.top_models_by_sales() == [
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=1)
+        ]
+        service.revert_sale("S1")
+        assert service.top_models_by_sales() == []
+
+    def test_iter_cars_pages_by_vin(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        service.sell_car(
+            Sale(
+                sales_number="20240903#JM1BL1TFXD1734246",
+                car_vin="JM1BL1TFXD1734246",
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2000"),
+            )
+        )
+
+        available = sorted(
+            car.vin for car in car_data if car.status == CarStatus.available and car.vin != "JM1BL1TFXD1734246"
+        )
+        first_page = [car.vin for car in service.iter_cars(CarStatus.available, limit=3)]
+        assert first_page == available[:3]
+        assert [car.vin for car in service.iter_cars(CarStatus.available, limit=3, offset=3)] == available[3:6]
+        assert [car.vin for car in service.iter_cars(CarStatus.available, after_vin=first_page[-1])] == available[3:]
+        assert [car.vin for car in service.iter_cars(CarStatus.sold)] == ["JM1BL1TFXD1734246"]
+
+    def test_bulk_load_from_feeds(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        cars_path = os.path.join(tmpdir, "feed_cars.csv")
+        with open(cars_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(Car.model_fields))
+            writer.writeheader()
+            for car in car_data:
+                writer.writerow(car.model_dump())
+
+        sales_path = os.path.join(tmpdir, "feed_sales.jsonl")
+        with open(sales_path, "w") as f:
+            for vin in ["KNAGM4A77D5316538", "KNAGH4A48A5414970", "JM1BL1TFXD1734246"]:
+                sale = Sale(sales_number=f"20240903#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1"))
+                f.write(sale.model_dump_json() + "\n")
+
+        assert service.bulk_load_models(model_data, batch_size=2) == len(model_data)
+        assert service.bulk_load_cars(cars_path, batch_size=4) == len(car_data)
+        assert service.bulk_load_sales(sales_path) == 3
+
+        assert service.get_cars(CarStatus.available) == [
+            car for car in car_data
+            if car.status == CarStatus.available
+            and car.vin not in {"KNAGM4A77D5316538", "KNAGH4A48A5414970", "JM1BL1TFXD1734246"}
+        ]
+        assert service.top_models_by_sales() == [
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=2),
+            ModelSaleStats(car_model_name="3", brand="Mazda", sales_number=1),
+        ]
+        with pytest.raises(ValueError):
+            service.bulk_load_cars(car_data[:1])
+
+    def test_bulk_load_reports_loaded_rows(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        service.bulk_load_models(model_data)
+
+        # Третья пачка повторяет VIN: первые две остаются загруженными
+        feed = car_data[:4] + [car_data[4], car_data[0]]
+        with pytest.raises(BulkLoadError, match="already exists") as error:
+            service.bulk_load_cars(feed, batch_size=2)
+        assert error.value.loaded == 4
+        assert [service.get_car_info(car.vin) is not None for car in car_data[:5]] == [True] * 4 + [False]
+
+        service.close()
+        reopened = CarService(tmpdir)
+        assert [reopened.get_car_info(car.vin) is not None for car in car_data[:5]] == [True] * 4 + [False]
+
+    def test_recover_after_crash(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        with CarService(tmpdir) as service:
+            self._fill_initial_data(service, car_data, model_data)
+
+        # Процесс завершается без flush(): изменения файлов данных остаются только в журнале
+        script = (
+            "import os, sys\n"
+            "from datetime import datetime\n"
+            "from decimal import Decimal\n"
+            "from bibip_car_service import CarService\n"
+            "from models import Sale\n"
+            "service = CarService(sys.argv[1])\n"
+            "service.sell_car(Sale(sales_number='20240903#KNAGM4A77D5316538', car_vin='KNAGM4A77D5316538',"
+            " sales_date=datetime(2024, 9, 3), cost=Decimal('2999.99')))\n"
+            "os._exit(0)\n"
+        )
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        subprocess.run([sys.executable, "-c", script, tmpdir], check=True, env=env)
+
+        service = CarService(tmpdir)
+        car = service.get_car_info("KNAGM4A77D5316538")
+        assert car is not None
+        assert car.status == CarStatus.sold
+        assert car.sales_cost == Decimal("2999.99")
+        assert service.top_models_by_sales(k=1) == [
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=1)
+        ]
+
+    def test_compact_after_reverted_sales(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        vins = [car.vin for car in car_data[:6]]
+        for vin in vins:
+            service.sell_car(
+                Sale(sales_number=f"20240903#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1"))
+            )
+        service.flush()
+        sales_size = os.path.getsize(os.path.join(tmpdir, "sales.txt"))
+        for vin in vins[:4]:
+            service.revert_sale(f"20240903#{vin}")
+        service.flush()
+        # Отмена продажи только помечает запись удалённой
+        assert os.path.getsize(os.path.join(tmpdir, "sales.txt")) == sales_size
+
+        assert service.compact("sales") == 4
+        assert os.path.getsize(os.path.join(tmpdir, "sales.txt")) == sales_size // 3
+
+        for vin in vins[4:]:
+            car = service.get_car_info(vin)
+            assert car is not None
+            assert car.status == CarStatus.sold
+            assert car.sales_cost == Decimal("1")
+        service.revert_sale(f"20240903#{vins[5]}")
+        service.close()
+
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info(vins[4]).status == CarStatus.sold
+        assert reopened.get_car_info(vins[5]).sales_date is None
+
+    def test_recover_after_crash_during_compact(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        vins = [car.vin for car in car_data[:8]]
+        with CarService(tmpdir) as service:
+            self._fill_initial_data(service, car_data, model_data)
+            for vin in vins[:6]:
+                service.sell_car(
+                    Sale(sales_number=f"1#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1")))
+
+        # После контрольной точки в журнале отмены со старыми номерами строк и новые продажи;
+        # процесс падает, когда файлы продаж уже подменены, а индексы ещё не записаны
+        script = (
+            "import os, sys\n"
+            "from datetime import datetime\n"
+            "from decimal import Decimal\n"
+            "import storage\n"
+            "from bibip_car_service import CarService\n"
+            "from models import Sale\n"
+            "service = CarService(sys.argv[1])\n"
+            "for vin in sys.argv[2:5]:\n"
+            "    service.revert_sale(f'1#{vin}')\n"
+            "for vin in sys.argv[8:]:\n"
+            "    service.sell_car(Sale(sales_number=f'2#{vin}', car_vin=vin, sales_date=datetime(2024, 9, 4),"
+            " cost=Decimal('2')))\n"
+            "storage.HashIndex.rebuild = lambda self, entries: os._exit(0)\n"
+            "service.compact('sales')\n"
+        )
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        subprocess.run([sys.executable, "-c", script, tmpdir, *vins], check=True, env=env)
+
+        service = CarService(tmpdir)
+        for vin in vins[:3]:
+            assert service.get_car_info(vin).status == CarStatus.available
+        for vin in vins[3:6]:
+            assert service.get_car_info(vin).sales_cost == Decimal("1")
+        for vin in vins[6:]:
+            assert service.get_car_info(vin).sales_cost == Decimal("2")
+        assert sum(stats.sales_number for stats in service.top_models_by_sales(k=10)) == 5
+        assert os.path.getsize(os.path.join(tmpdir, "sales.txt")) == 5 * (LINE_LEN + 1)
+        service.close()
+
+    def test_compact_keeps_writes_made_during_copy(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model], monkeypatch: pytest.MonkeyPatch
+    ):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        vins = [car.vin for car in car_data[:6]]
+        for vin in vins:
+            service.sell_car(
+                Sale(sales_number=f"1#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1"))
+            )
+        for vin in vins[:3]:
+            service.revert_sale(f"1#{vin}")
+        with pytest.raises(ValueError):
+            service.compact("unknown")
+
+        # Изменения между копированием и подменой файлов попадают в уплотнённую копию
+        copy_delta = CarService._copy_delta
+
+        def write_then_copy_delta(self, *args):
+            self.revert_sale(f"1#{vins[3]}")
+            self.sell_car(
+                Sale(sales_number=f"2#{vins[0]}", car_vin=vins[0], sales_date=datetime(2024, 9, 4), cost=Decimal("2"))
+            )
+            return copy_delta(self, *args)
+
+        monkeypatch.setattr(CarService, "_copy_delta", write_then_copy_delta)
+        assert service.compact("sales") == 3
+        monkeypatch.undo()
+        assert service.get_car_info(vins[0]).sales_cost == Decimal("2")
+        assert service.get_car_info(vins[3]).status == CarStatus.available
+        assert service.get_car_info(vins[4]).sales_cost == Decimal("1")
+        service.close()
+
+        # Автоматическое уплотнение идёт в фоновом потоке, отмена продажи его не ждёт
+        monkeypatch.setattr(bibip_car_service, "COMPACT_MIN_DEAD", 1)
+        service = CarService(tmpdir)
+        assert service.get_car_info(vins[0]).sales_cost == Decimal("2")
+        service.revert_sale(f"1#{vins[4]}")
+        service._compactor.join()
+        assert service.compact("sales") == 0
+        assert [car.vin for car in service.get_cars(CarStatus.sold)] == [vins[0], vins[5]]
+        service.close()
+
+    def test_sales_analytics_summary(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        for vin, day, cost in [
+            ("KNAGM4A77D5316538", datetime(2024, 9, 3), Decimal("1999.09")),
+            ("KNAGH4A48A5414970", datetime(2024, 10, 4), Decimal("2100")),
+            ("JM1BL1TFXD1734246", datetime(2024, 9, 5), Decimal("2000")),
+        ]:
+            service.sell_car(Sale(sales_number=f"{vin}#1", car_vin=vin, sales_date=day, cost=cost))
+
+        snapshot_path = os.path.join(tmpdir, "snapshot.npz")
+        service.snapshot().save(snapshot_path)
+        report = analytics.SalesAnalytics(analytics.ColumnarSnapshot.load(snapshot_path))
+
+        assert report.summary(by=("brand",)) == [
+            {"brand": "Kia", "units": 2, "revenue": Decimal("4099.09"), "average_discount": Decimal("0.46"),
+             "average_days_on_lot": 195.5},
+            {"brand": "Mazda", "units": 1, "revenue": Decimal("2000"), "average_discount": Decimal("276.65"),
+             "average_days_on_lot": 111.0},
+        ]
+        assert [(row["month"], row["model"], row["units"]) for row in report.summary(by=("month", "model"))] == [
+            ("2024-09", "Optima", 1),
+            ("2024-09", "3", 1),
+            ("2024-10", "Optima", 1),
+        ]
+
+        # 30 сентября 23:30 по UTC-2 — это уже 1 октября по UTC: месяц тот же, что у sales_by_date
+        late = datetime(2024, 9, 30, 23, 30, tzinfo=timezone(timedelta(hours=-2)))
+        service.sell_car(Sale(sales_number="late#1", car_vin="JM1BL1L83C1660152", sales_date=late, cost=Decimal("1")))
+        assert [sale.sales_number for sale in service.sales_by_date(datetime(2024, 10, 1), datetime(2024, 11, 1))] == [
+            "late#1", "KNAGH4A48A5414970#1"]
+        report = analytics.SalesAnalytics(service.snapshot())
+        assert [(row["month"], row["model"], row["units"]) for row in report.summary(by=("month", "model"))] == [
+            ("2024-09", "Optima", 1),
+            ("2024-09", "3", 1),
+            ("2024-10", "Optima", 1),
+            ("2024-10", "3", 1),
+        ]
+
+    def test_concurrent_sales_of_one_car(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        def sell(i: int) -> bool:
+            sale = Sale(sales_number=f"{i}#KNAGM4A77D5316538", car_vin="KNAGM4A77D5316538",
+                        sales_date=datetime(2024, 9, 3), cost=Decimal("1000"))
+            try:
+                service.sell_car(sale)
+            except ValueError:
+                return False
+            return True
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            assert sum(pool.map(sell, range(16))) == 1
+        assert service.top_models_by_sales(k=1) == [
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=1)
+        ]
+
+    def test_two_services_share_root_dir(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        # Два экземпляра с отдельными файловыми блокировками ведут себя как два процесса
+        first = CarService(tmpdir)
+        self._fill_initial_data(first, car_data, model_data)
+        second = CarService(tmpdir)
+
+        vin = "KNAGM4A77D5316538"
+        first.sell_car(Sale(sales_number=f"1#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1")))
+        assert second.get_car_info(vin).status == CarStatus.sold
+        with pytest.raises(ValueError):
+            second.sell_car(
+                Sale(sales_number=f"2#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1"))
+            )
+
+        second.revert_sale(f"1#{vin}")
+        second.flush()
+        new_vin = "KNAGM4A77D5316539"
+        first.update_vin(vin, new_vin)
+        assert second.get_car_info(vin) is None
+        assert second.get_car_info(new_vin).status == CarStatus.available
+        assert second.top_models_by_sales() == []
+
+        assert first.compact("sales") == 1
+        second.sell_car(
+            Sale(sales_number=f"3#{new_vin}", car_vin=new_vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1"))
+        )
+        assert first.get_car_info(new_vin).sales_cost == Decimal("1")
+        first.close()
+        second.close()
+
+    def test_async_sales_share_one_fsync(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model], monkeypatch: pytest.MonkeyPatch
+    ):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+
+        fsyncs = []
+        real_fsync = os.fsync
+        monkeypatch.setattr(os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+
+        async def scenario() -> list:
+            async with AsyncCarService(service) as front:
+                sales = [
+                    Sale(sales_number=f"{i}#{car.vin}", car_vin=car.vin, sales_date=datetime(2024, 9, 3),
+                         cost=Decimal("1"))
+                    for i, car in enumerate(car_data[:5] + car_data[:1])
+                ]
+                results = await asyncio.gather(*(front.sell_car(sale) for sale in sales), return_exceptions=True)
+                info = await front.get_car_info(car_data[0].vin)
+                assert info.status == CarStatus.sold
+                return results
+
+        results = asyncio.run(scenario())
+        # Повторная продажа первой машины отклонена, остальные записаны одной пачкой
+        assert [isinstance(result, ValueError) for result in results] == [False] * 5 + [True]
+        assert len(fsyncs) == 1
+        service.close()
+
+    def test_threaded_sales_share_fsync(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model], monkeypatch: pytest.MonkeyPatch
+    ):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        service._journal.commit_delay = 0.05
+
+        fsyncs = []
+        real_fsync = os.fsync
+        monkeypatch.setattr(os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+
+        sales = [
+            Sale(sales_number=f"{i}#{car.vin}", car_vin=car.vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1"))
+            for i, car in enumerate(car_data[:8])
+        ]
+        # Пока блокировка писателя занята, все продажи встают в очередь
+        with ThreadPoolExecutor(max_workers=len(sales)) as pool:
+            with service._lock.write():
+                futures = [pool.submit(service.sell_car, sale) for sale in sales]
+                while service._lock._writers_waiting < len(sales):
+                    time.sleep(0.001)
+            for future in futures:
+                future.result()
+
+        assert len(fsyncs) < len(sales)
+        assert all(service.get_car_info(car.vin).status == CarStatus.sold for car in car_data[:8])
+        service.close()
+        reopened = CarService(tmpdir)
+        assert all(reopened.get_car_info(car.vin).status == CarStatus.sold for car in car_data[:8])
+        reopened.close()
+
+    def test_car_info_cache_invalidation(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir, info_cache_size=3)
+        cache = service.info_cache
+
+        self._fill_initial_data(service, car_data, model_data[1:])
+        vin = "KNAGM4A77D5316538"  # машина модели 1, которой ещё нет
+        assert service.get_car_info(vin).car_model_name == "Unknown"
+        sorento = service.get_car_info("5XYPH4A10GG021831")
+        mazda = service.get_car_info("JM1BL1TFXD1734246")
+        assert service.get_car_info("JM1BL1TFXD1734246") is mazda
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 3, 0)
+
+        # Новая модель сбрасывает только машины этой модели
+        service.add_model(model_data[0])
+        assert service.get_car_info(vin).car_model_name == "Optima"
+        assert service.get_car_info("5XYPH4A10GG021831") is sorento
+        assert service.get_car_info("JM1BL1TFXD1734246") is mazda
+
+        service.sell_car(Sale(sales_number=f"1#{vin}", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("1")))
+        assert service.get_car_info(vin).status == CarStatus.sold
+        assert service.get_car_info("JM1BL1TFXD1734246") is mazda
+        service.update_vin(vin, "KNAGM4A77D5316539")
+        assert service.get_car_info(vin) is None
+        assert service.get_car_info("KNAGM4A77D5316539").sales_cost == Decimal("1")
+        service.revert_sale(f"1#{vin}")
+        assert service.get_car_info("KNAGM4A77D5316539").status == CarStatus.available
+
+        service.get_car_info("KNAGH4A48A5414970")
+        assert len(cache) == 3
+        assert cache.evictions > 0
+
+    def test_operation_stats(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        assert service.stats()["operations"] == {}
+
+        calls = []
+        service.profile_hook = lambda operation, seconds: calls.append(operation)
+        service.enable_metrics()
+        service.get_car_info("KNAGM4A77D5316538")
+        service.get_car_info("KNAGM4A77D5316538")
+        service.sell_car(
+            Sale(sales_number="1#KNAGH4A48A5414970", car_vin="KNAGH4A48A5414970", sales_date=datetime(2024, 9, 3),
+                 cost=Decimal("1"))
+        )
+
+        stats = service.stats()
+        assert calls == ["get_car_info", "get_car_info", "sell_car"]
+        assert stats["operations"]["get_car_info"]["count"] == 2
+        assert stats["operations"]["sell_car"]["p99_ms"] >= stats["operations"]["sell_car"]["p50_ms"] > 0
+        assert stats["cache"]["hits"] == 1
+        assert stats["io"]["index_probes"] > 0
+        assert stats["io"]["bytes_read"] > 0
+        assert stats["io"]["bytes_written"] > 0
+        assert stats["io"]["journal_fsyncs"] == 1
+
+        service.reset_stats()
+        stats = service.stats()
+        assert stats["operations"] == {} and stats["io"] == {} and stats["cache"]["hits"] == 0
+        service.enable_metrics(False)
+        service.profile_hook = None
+        service.get_car_info("KNAGM4A77D5316538")
+        assert service.stats()["operations"] == {}
+
+    def test_money_kept_exactly(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        service.add_car(
+            Car(vin="KNAGM4A77D5316539", model=1, price=Decimal("1999.99"), date_start=datetime(2024, 5, 1),
+                status=CarStatus.available)
+        )
+        # Доли сотой не отвергаются и не округляются
+        service.add_car(
+            Car(vin="KNAGM4A77D5316540", model=1, price=Decimal("1999.995"), date_start=datetime(2024, 5, 1),
+                status=CarStatus.available)
+        )
+        service.sell_car(
+            Sale(sales_number="1#KNAGM4A77D5316540", car_vin="KNAGM4A77D5316540", sales_date=datetime(2024, 9, 3),
+                 cost=Decimal("1.005"))
+        )
+        service.close()
+
+        # После повторного открытия (и без кэша) цены те же, а результаты — обычные модели
+        service = CarService(tmpdir)
+        info = service.get_car_info("KNAGM4A77D5316539")
+        assert info.price == Decimal("1999.99")
+        info = service.get_car_info("KNAGM4A77D5316540")
+        assert str(info.price) == "1999.995" and str(info.sales_cost) == "1.005"
+        cars = service.get_cars(CarStatus.available)
+        assert all(type(car) is Car for car in cars)
+        assert cars[0] == car_data[0]
+        assert cars[-1].price == Decimal("1999.99")
+        # Запись цены та же, что у переданного значения
+        assert str(cars[0].price) == "2000"
+        assert '"price":"2000"' in service.get_car_info(car_data[0].vin).model_dump_json()
+        # Индекс цен упорядочивает и доли сотой
+        assert [str(car.price) for car in service.cars_by_price(max_price=Decimal("2100"))] == [
+            "1999.99", "1999.995", "2000", "2100"]
+        assert [str(car.price) for car in service.cars_by_price(Decimal("1999.991"), Decimal("1999.995"))] == [
+            "1999.995"]
+        assert list(service.cars_by_price(Decimal("1999.991"), Decimal("1999.9949"))) == []
+        assert list(service.cars_by_price(Decimal("1999.9951"), Decimal("1999.999"))) == []
+
+    def test_range_queries(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model], monkeypatch: pytest.MonkeyPatch
+    ):
+        # Маленькие части, чтобы обход продолжался и внутри одинаковых значений ключа
+        monkeypatch.setattr(bibip_car_service, "ITER_CHUNK", 2)
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+
+        def vins(cars) -> list[str]:
+            return [car.vin for car in cars]
+
+        assert vins(service.cars_by_date_start(end=datetime(2024, 5, 17), status=CarStatus.available)) == [
+            "KNAGM4A77D5316538", "KNAGH4A48A5414970"]
+        assert vins(service.cars_by_date_start(datetime(2024, 6, 1), datetime(2024, 6, 2))) == [
+            "5N1CR2MN9EC641864", "JM1BL1L83C1660152", "5N1CR2TS0HW037674"]
+        assert vins(service.cars_by_price(Decimal("3100"), Decimal("3200"))) == [
+            "5N1CR2MN9EC641864", "5N1CR2TS0HW037674", "5N1AR2MM4DC605884"]
+        assert [car.price for car in service.cars_by_price(max_price=Decimal("2276.65"))] == [
+            Decimal("2000"), Decimal("2100"), Decimal("2276.65")]
+        # Границы с долями копеек округляются внутрь отрезка
+        assert [car.price for car in service.cars_by_price(Decimal("1999.995"), Decimal("2100.005"))] == [
+            Decimal("2000"), Decimal("2100")]
+        assert list(service.cars_by_price(Decimal("2000.001"), Decimal("2099.999"))) == []
+
+        service.sell_car(
+            Sale(sales_number="20240903#5N1CR2MN9EC641864", car_vin="5N1CR2MN9EC641864",
+                 sales_date=datetime(2024, 9, 3), cost=Decimal("3000"))
+        )
+        assert vins(service.cars_by_price(Decimal("3100"), Decimal("3200"), CarStatus.available)) == [
+            "5N1CR2TS0HW037674", "5N1AR2MM4DC605884"]
+        assert vins(service.cars_by_price(status=CarStatus.sold)) == ["5N1CR2MN9EC641864"]
+        assert [sale.sales_number for sale in service.sales_by_date(datetime(2024, 9, 1), datetime(2024, 10, 1))] == [
+            "20240903#5N1CR2MN9EC641864"]
+        assert list(service.sales_by_date(end=datetime(2024, 9, 1))) == []
+        service.close()
+
+        # Каталог без файла индекса (от прошлой версии) получает его при открытии
+        os.remove(os.path.join(tmpdir, "cars_price_index.txt"))
+        service = CarService(tmpdir)
+        assert vins(service.cars_by_price(Decimal("3100"), Decimal("3200"), CarStatus.available)) == [
+            "5N1CR2TS0HW037674", "5N1AR2MM4DC605884"]
+
+    def test_sharded_storage(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model], monkeypatch: pytest.MonkeyPatch
+    ):
+        # Полные проходы идут через пул процессов даже на маленьких данных
+        monkeypatch.setattr(sharding, "PARALLEL_SCAN_MIN_ROWS", 0)
+        service = CarService(tmpdir, shards=4)
+        self._fill_initial_data(service, car_data, model_data)
+        assert os.path.exists(os.path.join(tmpdir, "cars_0.txt"))
+        assert not os.path.exists(os.path.join(tmpdir, "cars.txt"))
+
+        for vin in ["KNAGM4A77D5316538", "KNAGH4A48A5414970", "5N1CR2MN9EC641864"]:
+            service.sell_car(
+                Sale(sales_number=f"{vin}#1", car_vin=vin, sales_date=datetime(2024, 9, 3), cost=Decimal("2000"))
+            )
+        # Новый VIN из другого шарда: машина переезжает вместе с продажей
+        old_vin, new_vin = "KNAGM4A77D5316538", "KNAGM4A77D5316530"
+        assert sharding.shard_of(old_vin, 4) != sharding.shard_of(new_vin, 4)
+        service.update_vin(old_vin, new_vin)
+        assert service.get_car_info(old_vin) is None
+        assert service.get_car_info(new_vin).sales_cost == Decimal("2000")
+        assert service.top_models_by_sales(k=1) == [ModelSaleStats(car_model_name="Optima", brand="Kia",
+                                                                    sales_number=2)]
+        service.revert_sale(f"{old_vin}#1")
+        assert service.get_car_info(new_vin).status == CarStatus.available
+        assert [car.vin for car in service.get_cars(CarStatus.sold)] == ["KNAGH4A48A5414970", "5N1CR2MN9EC641864"]
+
+        report = analytics.SalesAnalytics(service.snapshot())
+        assert [(row["brand"], row["units"]) for row in report.summary(by=("brand",))] == [("Kia", 1), ("Nissan", 1)]
+        service.close()
+
+        with pytest.raises(ValueError):
+            CarService(tmpdir, shards=2)
+        # Рейтинг без сохранённого файла пересчитывается по шардам
+        os.remove(os.path.join(tmpdir, "model_sales.json"))
+        service = CarService(tmpdir)
+        assert [(stats.car_model_name, stats.sales_number) for stats in service.top_models_by_sales()] == [
+            ("Optima", 1), ("Pathfinder", 1)]
+        assert service.get_car_info(new_vin).status == CarStatus.available
+        service.close()
+
+    def test_lazy_open(
+        self, tmpdir: str, car_data: list[Car], model_data: list[Model], monkeypatch: pytest.MonkeyPatch
+    ):
+        # Словарь индекса строится только после len(index) запросов
+        monkeypatch.setattr(storage, "LOAD_AFTER_RATIO", 1)
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        service.close()
+        meta = read_meta(tmpdir)
+        assert meta["schema"] == SCHEMA_VERSION and meta["line_len"] == LINE_LEN
+        assert meta["counts"]["cars"] == len(car_data)
+
+        # Запросы до и после построения словаря индекса, изменения между ними
+        service = CarService(tmpdir)
+        assert service.get_car_info("KNAGM4A77D5316538").car_model_name == "Optima"
+        service.sell_car(
+            Sale(sales_number="1#KNAGM4A77D5316538", car_vin="KNAGM4A77D5316538", sales_date=datetime(2024, 9, 3),
+                 cost=Decimal("1"))
+        )
+        for _ in range(3):
+            for car in car_data:
+                assert service.get_car_info(car.vin) is not None
+                service.info_cache.invalidate(car.vin)
+        # Словарь строит фоновый поток по файлу, изменения после открытия добавляются при подключении
+        index = service._cars_index
+        while not index.loaded:
+            if index._loader is not None:
+                index._loader.join()
+            service.info_cache.invalidate("KNAGM4A77D5316538")
+            assert service.get_car_info("KNAGM4A77D5316538").status == CarStatus.sold
+        service.revert_sale("1#KNAGM4A77D5316538")
+        assert service.get_car_info("KNAGM4A77D5316538").status == CarStatus.available
+        service.sell_car(
+            Sale(sales_number="1#KNAGM4A77D5316538", car_vin="KNAGM4A77D5316538", sales_date=datetime(2024, 9, 3),
+                 cost=Decimal("1"))
+        )
+        service.update_vin("KNAGM4A77D5316538", "KNAGM4A77D5316539")
+        assert service.get_car_info("KNAGM4A77D5316538") is None
+        assert service.get_car_info("KNAGM4A77D5316539").sales_cost == Decimal("1")
+        service.close()
+
+        meta = read_meta(tmpdir)
+        write_meta(tmpdir, {**meta, "line_len": LINE_LEN + 1})
+        with pytest.raises(ValueError):
+            CarService(tmpdir)
+
+    def test_update_vin_is_atomic(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        service.sell_car(
+            Sale(sales_number="20240903#KNAGM4A77D5316538", car_vin="KNAGM4A77D5316538",
+                 sales_date=datetime(2024, 9, 3), cost=Decimal("1999.09"))
+        )
+        before = service.get_car_info("KNAGM4A77D5316538")
+
+        # Занятый VIN и VIN, который не помещается в ключ индекса, отвергаются без изменений
+        with pytest.raises(ValueError):
+            service.update_vin("KNAGM4A77D5316538", "5XYPH4A10GG021831")
+        with pytest.raises(ValueError):
+            service.update_vin("KNAGM4A77D5316538", "X" * 100)
+        assert service.get_car_info("KNAGM4A77D5316538") == before
+        assert [car.vin for car in service.get_cars(CarStatus.sold)] == ["KNAGM4A77D5316538"]
+        service.close()
+
+        service = CarService(tmpdir)
+        service.update_vin("KNAGM4A77D5316538", "KNAGM4A77D5316539")
+        assert service.get_car_info("KNAGM4A77D5316539").sales_cost == Decimal("1999.09")
+        assert [car.vin for car in service.get_cars(CarStatus.sold)] == ["KNAGM4A77D5316539"]
+        service.close()
+
+        service = CarService(tmpdir)
+        assert service.get_car_info("KNAGM4A77D5316538") is None
+        service.revert_sale("20240903#KNAGM4A77D5316538")
+        assert service.get_car_info("KNAGM4A77D5316539").status == CarStatus.available